@@ -0,0 +1,99 @@
+"""
+Benchmarks the checkout phase of installing a module with a large
+working tree, comparing git's default checkout settings with the
+ones mpm applies. A synthetic fixture repo is generated with git
+fast-import, cloned without a checkout, and then checked out with
+each set of settings. Run from the repository root:
+
+    python benchmarks/checkout_benchmark.py --files 100000
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mpm_helpers import clone_helper, checkout_helper, checkout_settings_helper, head_sha_helper, onerror_helper
+
+# Checkout settings matching git's own defaults
+GIT_DEFAULTS = {'workers': 1, 'preload_index': True, 'untracked_cache': False}
+
+def create_fixture(path, files, size):
+    """
+    Creates a bare repo at path with a single commit of files files
+    of about size bytes each, spread over nested directories.
+    """
+    subprocess.check_call(['git', 'init', '-q', '--bare', path])
+    importer = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=path, stdin=subprocess.PIPE)
+    importer.stdin.write(b'commit refs/heads/master\ncommitter mpm <mpm@example.com> 0 +0000\ndata 7\nfixture\n')
+    for index in range(files):
+        line = '{}\n'.format(index).encode('ascii')
+        content = line * max(1, size // len(line))
+        filename = 'dir{}/sub{}/file{}.txt'.format(index // 10000, index // 100 % 100, index).encode('ascii')
+        importer.stdin.write(b'M 100644 inline ' + filename + b'\ndata ' + str(len(content)).encode('ascii') + b'\n' + content + b'\n')
+    importer.stdin.close()
+    if importer.wait():
+        raise click.ClickException('git fast-import failed.')
+
+def time_checkout(remote_url, path, sha, checkout):
+    """
+    Clones the fixture without a checkout, applies the checkout
+    settings and returns the seconds taken by the checkout and by
+    the first and second git status afterwards.
+    """
+    clone_helper(remote_url, path, no_checkout=True)
+    checkout_settings_helper(path, checkout)
+    if os.name != 'nt':
+        # Start every checkout without writes of earlier runs pending
+        subprocess.check_call(['sync'])
+    start = time.time()
+    checkout_helper(path, sha, sha)
+    timings = [time.time() - start]
+    for _ in range(2):
+        start = time.time()
+        subprocess.check_call(['git', 'status', '--porcelain'], cwd=path, stdout=subprocess.PIPE)
+        timings.append(time.time() - start)
+    return timings
+
+@click.command()
+@click.option('--files', type=int, show_default=True, default=50000, help='The number of files in the fixture.')
+@click.option('--size', type=int, show_default=True, default=2048, help='The approximate size of each file in bytes.')
+@click.option('--repeat', type=int, show_default=True, default=3, help='Checkouts per set of settings; the fastest is reported.')
+@click.option('-w', '--workers', type=int, multiple=True, help='Also benchmark this number of checkout workers. Can be repeated.')
+def main(files, size, repeat, workers):
+    root = tempfile.mkdtemp(prefix='mpm-checkout-benchmark-')
+    try:
+        fixture = os.path.join(root, 'fixture.git')
+        click.echo('Creating a fixture with {} files of {} bytes...'.format(files, size))
+        create_fixture(fixture, files, size)
+        remote_url = 'file://' + fixture
+        sha = head_sha_helper(fixture)
+
+        candidates = [('git defaults', GIT_DEFAULTS), ('mpm defaults', None), ('untracked cache', {'untracked_cache': True})]
+        for count in workers:
+            candidates.append(('{} workers'.format(count), {'workers': count}))
+
+        # Alternate between the settings so that disk cache and load
+        # changes over the run affect them all alike
+        best = [None] * len(candidates)
+        for attempt in range(repeat):
+            for index, (label, checkout) in enumerate(candidates):
+                path = os.path.join(root, 'checkout')
+                timings = time_checkout(remote_url, path, sha, checkout)
+                shutil.rmtree(path, onerror=onerror_helper)
+                if best[index] is None or timings[0] < best[index][0]:
+                    best[index] = timings
+
+        baseline = best[0][0]
+        click.echo('{:<15} {:>10} {:>9} {:>12} {:>13}'.format('settings', 'checkout', 'speedup', 'first status', 'second status'))
+        for (label, checkout), timings in zip(candidates, best):
+            click.echo('{:<15} {:>9.2f}s {:>8.2f}x {:>11.2f}s {:>12.2f}s'.format(label, timings[0], baseline / timings[0], timings[1], timings[2]))
+    finally:
+        shutil.rmtree(root, onerror=onerror_helper)
+
+if __name__ == '__main__':
+    main()
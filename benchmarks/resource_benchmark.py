@@ -0,0 +1,75 @@
+"""
+Reports the memory, open file descriptors and child processes of
+one mpm process as it installs and updates a growing number of
+modules, as a long running mpm daemon would. Synthetic fixture
+repos are generated with git fast-import and every command runs in
+this process, so the numbers should stay flat as modules are added.
+Run from the repository root:
+
+    python benchmarks/resource_benchmark.py --modules 200
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from click.testing import CliRunner
+from mpm_cli import cli
+from mpm_helpers import format_bytes_helper, onerror_helper, resource_usage_helper
+
+def create_fixture(path):
+    """
+    Creates a bare repo at path with a single commit of one file.
+    """
+    subprocess.check_call(['git', 'init', '-q', '--bare', path])
+    importer = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=path, stdin=subprocess.PIPE)
+    importer.communicate(b'commit refs/heads/master\ncommitter mpm <mpm@example.com> 0 +0000\ndata 7\nfixture\n'
+                         b'M 100644 inline file.txt\ndata 8\nfixture\n\n')
+    if importer.returncode:
+        raise click.ClickException('git fast-import failed.')
+
+def run(runner, args):
+    """
+    Runs an mpm command in this process, raising if it fails.
+    """
+    result = runner.invoke(cli, ['--no-ssh-multiplexing'] + args)
+    if result.exit_code:
+        raise click.ClickException('mpm ' + ' '.join(args) + ' failed:\n' + result.output)
+
+def report(label, usage):
+    click.echo('{:<12} {:>12} {:>6} {:>9}'.format(label, format_bytes_helper(usage['rss']) if usage['rss'] is not None else '-',
+                                                 usage['fds'] if usage['fds'] is not None else '-',
+                                                 usage['children'] if usage['children'] is not None else '-'))
+
+@click.command()
+@click.option('--modules', type=int, show_default=True, default=100, help='The number of modules to install.')
+@click.option('--every', type=int, show_default=True, default=20, help='Report after installing this many modules.')
+def main(modules, every):
+    root = tempfile.mkdtemp(prefix='mpm-resource-benchmark-')
+    cwd = os.getcwd()
+    try:
+        fixture = os.path.join(root, 'fixture.git')
+        create_fixture(fixture)
+        workspace = os.path.join(root, 'workspace')
+        os.mkdir(workspace)
+        os.chdir(workspace)
+        runner = CliRunner()
+
+        click.echo('{:<12} {:>12} {:>6} {:>9}'.format('modules', 'rss', 'fds', 'children'))
+        report('0', resource_usage_helper())
+        for index in range(1, modules + 1):
+            run(runner, ['install', 'file://' + fixture, '-n', 'module{}'.format(index)])
+            if index % every == 0 or index == modules:
+                report(str(index), resource_usage_helper())
+        run(runner, ['update', '--all'])
+        report('update --all', resource_usage_helper())
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root, onerror=onerror_helper)
+
+if __name__ == '__main__':
+    main()
@@ -1,153 +1,611 @@
 import os
-import shutil
+import fnmatch
+import json
+import multiprocessing
 import sys
+import threading
+import time
 import click
 
+from collections import OrderedDict
+from contextlib import contextmanager
+
 from mpm_yaml_storage import YAMLStorage
-from mpm_helpers import clone_and_checkout_helper, clone_helper, checkout_helper, yaml_to_path_helper, path_to_yaml_helper, onerror_helper, remove_from_gitignore_helper, add_to_gitignore_helper, is_local_commit_helper, with_open_or_create_tinydb_helper, with_open_or_create_file_helper, create_directory_helper
+from mpm_sqlite_storage import SQLiteStorage
+from mpm_helpers import clone_and_checkout_helper, clone_helper, checkout_helper, yaml_to_path_helper, path_to_yaml_helper, onerror_helper, remove_from_gitignore_helper, add_to_gitignore_helper, is_local_commit_helper, with_open_or_create_tinydb_helper, with_open_or_create_file_helper, create_directory_helper, move_to_trash_helper, reap_trash_helper, is_sha_helper, is_ancestor_helper, head_sha_helper, resolve_reference_helper, read_gitmodules_helper, gitlink_shas_helper, remove_config_sections_helper, detach_submodule_gitdir_helper, migrate_tinydb_helper, cached_refs_helper, cached_ls_remote_all_helper, stream_manifest_products_helper, write_product_db_helper, maintain_repo_helper, format_bytes_helper, file_lock_helper, module_lock_filepath_helper, host_slot_helper, checkout_config_helper, write_journal_helper, clear_journal_helper, read_journal_helper, recover_module_helper, linked_store_helper, store_checkout_helper, unlink_store_module_helper, move_store_module_helper, gc_store_helper, prefetch_repo_helper, prefetch_time_helper, read_remote_cache_helper, write_remote_cache_helper, repo_stats_helper, perf_remedies_helper, remote_uses_ssh_helper, start_ssh_multiplexing_helper, MAX_OPEN_REPOS
 from tinydb import TinyDB, Query
-from git import Repo, GitCommandError, RemoteProgress
+from tinydb.operations import delete
+from multiprocessing.pool import ThreadPool
+from git import Git, GitCommandError, RemoteProgress
+
+# Storage types the working database can use, with their default filenames
+DB_STORAGES = {
+    'yaml': (YAMLStorage, 'mpm-db.yml'),
+    'sqlite': (SQLiteStorage, 'mpm-db.sqlite'),
+}
+
+# Seconds a remote's listed refs are trusted before listing it again
+REMOTE_CACHE_TTL = 300
+
+# Seconds after a prefetch before a module is prefetched again
+PREFETCH_TTL = 600
+
+# Minimum seconds to wait for another process to release the database
+METADATA_LOCK_TIMEOUT = 30
 
 class MPMMetadata:
     """
     Contains the path, storage type, and default table name for
-    the internal database.
+    the internal database, as well as the trash directory used
+    for deferred module deletion, the remote refs cache file, the
+    lock directory, lock timeout and per host operation limit used
+    to coordinate concurrent mpm processes, the journal directory
+    recording the progress of unfinished operations, the module
+    store new modules are linked from, if one is used, and whether
+    SSH connections are shared once the first one is made.
     """
-    def __init__(self, filepath, storage, table_name, gitignore_name):
+    def __init__(self, filepath, storage, table_name, gitignore_name, trash_path=None, remote_cache_path=None, lock_path=None, lock_timeout=None, host_limit=None, journal_path=None, store_path=None):
         self.filepath = filepath
         self.storage = storage
         self.table_name = table_name
         self.gitignore_name = gitignore_name
+        if not trash_path:
+            trash_path = os.path.join(os.path.dirname(filepath), 'trash')
+        self.trash_path = trash_path
+        if not remote_cache_path:
+            remote_cache_path = os.path.join(os.path.dirname(filepath), 'remote-refs.yml')
+        self.remote_cache_path = remote_cache_path
+        if not lock_path:
+            lock_path = os.path.join(os.path.dirname(filepath), 'locks')
+        self.lock_path = lock_path
+        self.lock_timeout = lock_timeout
+        self.host_limit = host_limit
+        if not journal_path:
+            journal_path = os.path.join(os.path.dirname(filepath), 'journal')
+        self.journal_path = journal_path
+        if store_path:
+            store_path = os.path.abspath(os.path.expanduser(store_path))
+        self.store_path = store_path
+        self.ssh_multiplexing = False
+        self.stop_ssh_multiplexing = None
+        self.ssh_lock = threading.Lock()
+
+    def lock_metadata(self):
+        """
+        Locks the database and gitignore against other mpm processes.
+        Only held while they are read or written, never during clones,
+        so it is waited for at least METADATA_LOCK_TIMEOUT seconds
+        even when the lock timeout asks to fail fast.
+        """
+        timeout = self.lock_timeout
+        if timeout is not None:
+            timeout = max(timeout, METADATA_LOCK_TIMEOUT)
+        return file_lock_helper(os.path.join(self.lock_path, 'metadata.lock'), timeout, 'the mpm database')
+
+    def lock_module(self, path):
+        """
+        Locks the module checked out at path against other mpm
+        processes while it is cloned, checked out or moved. Always
+        taken before, never inside, the metadata lock.
+        """
+        return file_lock_helper(module_lock_filepath_helper(self.lock_path, path), self.lock_timeout, 'module ' + path_to_yaml_helper(path))
+
+    def host_slot(self, remote_url):
+        """
+        Holds one of the host_limit slots of the remote's host, shared
+        with other mpm processes, around a network git operation. The
+        first operation over SSH sets up SSH multiplexing if enabled,
+        so commands that never connect to a host don't pay for it.
+        """
+        if self.ssh_multiplexing and remote_uses_ssh_helper(remote_url):
+            with self.ssh_lock:
+                if self.ssh_multiplexing:
+                    self.ssh_multiplexing = False
+                    self.stop_ssh_multiplexing = start_ssh_multiplexing_helper()
+        return host_slot_helper(self.lock_path, remote_url, self.host_limit)
+
+    def close(self):
+        """
+        Closes the shared SSH connections, if any were made.
+        """
+        if self.stop_ssh_multiplexing:
+            self.stop_ssh_multiplexing()
+            self.stop_ssh_multiplexing = None
 
-def mpm_init(ctx, db_table='mpm', db_path='.mpm/', db_filename='mpm-db.yml', db_storage=YAMLStorage, gitignore='.gitignore'):
+    def journal(self, path, name, remote_url, reference):
+        """
+        Returns a function that durably records each step of a clone
+        or checkout of the module at path, so an interrupted operation
+        can be cleaned up or resumed. The journal is cleared once the
+        database is updated.
+        """
+        def record(step, sha=None):
+            entry = {'step': step, 'name': name, 'remote_url': remote_url, 'reference': reference, 'time': time.time()}
+            if sha:
+                entry['sha'] = sha
+            write_journal_helper(self.journal_path, path, entry)
+        return record
+
+    def module_store(self, path):
+        """
+        Returns the store the module at path links into, or the store
+        in use if the module is not checked out yet. Modules that are
+        already cloned in place stay that way, so None is returned.
+        """
+        return linked_store_helper(path) or (self.store_path if not os.path.exists(os.path.join(path, '.git')) else None)
+
+    def clone_and_checkout(self, remote_url, reference, path, remote_sha=None, sparse=None, checkout=None, journal=None):
+        """
+        Clones and checks out the module at path, or links it to the
+        commit in the module store. Store entries are found by SHA, so
+        references that are not SHAs are resolved upstream first.
+        """
+        store_path = self.module_store(path)
+        if not store_path:
+            clone_and_checkout_helper(remote_url, reference, path, remote_sha, sparse, checkout, journal)
+            return
+        if not remote_sha:
+            refs = cached_ls_remote_all_helper([remote_url], self.remote_cache_path, REMOTE_CACHE_TTL).get(remote_url)
+            remote_sha = resolve_reference_helper(refs or {}, reference)
+        store_checkout_helper(store_path, self.trash_path, remote_url, reference, path, remote_sha, sparse, checkout, self.lock_timeout)
+
+    @contextmanager
+    def open_db(self):
+        """
+        Opens the database under the metadata lock. It is reopened
+        for every locked session so that new document ids never
+        clash with those inserted by other processes meanwhile.
+        """
+        with self.lock_metadata():
+            with TinyDB(self.filepath, storage=self.storage, default_table=self.table_name) as mpm_db:
+                yield mpm_db
+
+def mpm_init(ctx, db_table='mpm', db_path='.mpm/', db_filename=None, db_storage=None, gitignore='.gitignore', lock_timeout=None, host_limit=None, store_path=None, migrate=False, ssh_multiplexing=False):
     """
     Initialize the mpm database. Called on every command
     issued with mpm. If the file does not already exist,
     create it. Save the database information in the DBWrapper
-    class, to be passed to the other commands.
+    class, to be passed to the other commands. If no storage type
+    is given, the storage of the existing database is used, or YAML
+    for a new one. If a storage type is given but the database
+    exists in another one, the modules are migrated to the given
+    storage if migrate is set, and otherwise the existing database
+    is used with a warning. Locks taken by
+    the commands wait up to lock_timeout seconds for other mpm
+    processes, or forever if it is None, and at most host_limit
+    network operations run against a git host at once. If a
+    store_path is given, new modules are links into that store. With
+    ssh_multiplexing, SSH connections are shared from the first one
+    on, until the click context closes.
     """
     create_directory_helper(db_path)
-    db_filepath = os.path.join(db_path, db_filename)
+    metadata = MPMMetadata(None, None, db_table, gitignore, os.path.join(db_path, 'trash'), os.path.join(db_path, 'remote-refs.yml'), os.path.join(db_path, 'locks'), lock_timeout, host_limit, os.path.join(db_path, 'journal'), store_path)
 
-    # Create files if they don't already exist
-    with_open_or_create_tinydb_helper(db_filepath, db_storage, db_table)
-    with_open_or_create_file_helper(gitignore, 'a+')
+    with metadata.lock_metadata():
+        existing = [(storage, filename) for name, (storage, filename) in sorted(DB_STORAGES.items())
+                    if os.path.isfile(os.path.join(db_path, filename))]
+        if not db_storage:
+            db_storage, default_filename = (existing or [DB_STORAGES['yaml']])[0]
+            db_filename = db_filename or default_filename
+        elif not db_filename:
+            db_filename = [filename for storage, filename in DB_STORAGES.values() if storage == db_storage][0]
+        db_filepath = os.path.join(db_path, db_filename)
+        if not os.path.exists(db_filepath):
+            for storage, filename in existing:
+                existing_filepath = os.path.join(db_path, filename)
+                if storage == db_storage:
+                    continue
+                if migrate:
+                    click.echo('Migrating ' + existing_filepath + ' to ' + db_filepath + '...')
+                    migrate_tinydb_helper(existing_filepath, storage, db_filepath, db_storage)
+                    os.rename(existing_filepath, existing_filepath + '.migrated')
+                else:
+                    click.echo('WARNING: Using the existing database ' + existing_filepath + '. Add --migrate-storage to migrate it to ' + db_filepath + '.')
+                    db_storage, db_filepath = storage, existing_filepath
+                break
+        metadata.filepath, metadata.storage = db_filepath, db_storage
 
-    add_to_gitignore_helper(gitignore, db_path)
+        # Create files if they don't already exist
+        with_open_or_create_tinydb_helper(db_filepath, db_storage, db_table)
+        with_open_or_create_file_helper(gitignore, 'a+')
 
-    metadata = MPMMetadata(db_filepath, db_storage, db_table, gitignore)
+        add_to_gitignore_helper(gitignore, db_path)
+
+    if ssh_multiplexing:
+        metadata.ssh_multiplexing = True
+        ctx.call_on_close(metadata.close)
     ctx.obj = metadata # Set the click context object
 
     return metadata
 
-def mpm_install(db, remote_url, reference, directory, name):
+def mpm_install(db, remote_url, reference, directory, name, sparse=None, checkout=None, resume=False):
     """
     Install a module with GitPython using the reference,
     remote_url, directory, and path parameters, then create
     a database entry. If the module already exists in the
     database and the filesystem, do nothing. If the module
     exists in the database but not on the filesytem, reinstall
-    the module.
+    the module. If a list of sparse directories is given, only
+    those directories of the module are checked out. If a module
+    store is used, the module is linked from the store instead. The checkout
+    dict overrides the module's default checkout settings. The module
+    path stays locked while it is cloned, so installs of other
+    modules can run concurrently. Each step is journaled: a clone
+    left unfinished by an earlier run is removed and cloned again,
+    and later steps are finished. With resume, the commit fetched
+    by the earlier run is checked out without fetching again.
     """
-    with TinyDB(db.filepath, storage=db.storage, default_table=db.table_name) as mpm_db:
-        if not name:
-            # Use the default module name
-            module_name = os.path.basename(remote_url).split('.git')[0]
-        else:
-            # Use the user provided module name
-            module_name = name
+    if not name:
+        # Use the default module name
+        module_name = os.path.basename(remote_url).split('.git')[0]
+    else:
+        # Use the user provided module name
+        module_name = name
 
-        module = Query()
-        db_entry = mpm_db.get(module.name == module_name)
-        full_path = os.path.join(directory, module_name)
-        add_to_gitignore_helper(db.gitignore_name, full_path)
+    module = Query()
+    full_path = os.path.join(directory, module_name)
+    with db.lock_module(full_path.strip(os.path.sep)):
+        with db.open_db() as mpm_db:
+            db_entry = mpm_db.get(module.name == module_name)
+            add_to_gitignore_helper(db.gitignore_name, full_path, not db.module_store(full_path.strip(os.path.sep)))
         full_path = full_path.strip(os.path.sep)
         new_db_entry = {'name': module_name, 'remote_url': remote_url, 'reference': reference, 'path': path_to_yaml_helper(full_path)}
-        if db_entry and os.path.exists(os.path.join(yaml_to_path_helper(db_entry['path']), '.git')):
+        if sparse:
+            new_db_entry['sparse'] = list(sparse)
+        if checkout:
+            checkout_config_helper(checkout)
+            new_db_entry['checkout'] = dict(checkout)
+        record = recover_module_helper(db.journal_path, db.trash_path, full_path, remote_url)
+        if db_entry and not record and os.path.exists(os.path.join(yaml_to_path_helper(db_entry['path']), '.git')):
             click.echo('Already Installed! If you wish to update the branch/reference, use the update command.')
-        elif db_entry and not os.path.exists(os.path.join(yaml_to_path_helper(db_entry['path']), '.git')):
-            click.echo('Folder missing, reinstalling ' + module_name + '...')
-            clone_and_checkout_helper(remote_url, reference, full_path)
-            mpm_db.update(new_db_entry, module.name == module_name)
         else:
-            click.echo('Installing ' + module_name + '...')
-            clone_and_checkout_helper(remote_url, reference, full_path)
-            mpm_db.insert(new_db_entry)
+            if record:
+                click.echo('Resuming ' + module_name + ' after step ' + record['step'] + '...')
+            elif db_entry:
+                click.echo('Folder missing, reinstalling ' + module_name + '...')
+            else:
+                click.echo('Installing ' + module_name + '...')
+            if resume and record and record.get('sha') and record['reference'] == reference:
+                remote_sha = record['sha']
+            else:
+                remote_sha = resolve_reference_helper(cached_refs_helper(db.remote_cache_path, remote_url, REMOTE_CACHE_TTL) or {}, reference)
+            with db.host_slot(remote_url):
+                db.clone_and_checkout(remote_url, reference, full_path, remote_sha, sparse, checkout, db.journal(full_path, module_name, remote_url, reference))
+            with db.open_db() as mpm_db:
+                if mpm_db.get(module.name == module_name):
+                    mpm_db.update(new_db_entry, module.name == module_name)
+                else:
+                    mpm_db.insert(new_db_entry)
+            clear_journal_helper(db.journal_path, full_path)
         click.echo('Install complete!')
 
-def mpm_uninstall(db, module_name):
+def mpm_uninstall(db, module_name, background=False, reap=True):
     """
     Uninstall a module by name and remove the database entry.
     If no module is found in the database, nothing is uninstalled.
+    The module folder is renamed into the trash so the database and
+    gitignore are updated right away, or for a module linked from a
+    store, the link is removed and the store entry is moved to the
+    trash if no workspace uses it anymore. Then the trash is emptied,
+    either here or by a detached background reaper. If reap is
+    False the trash is left for the caller to empty.
     """
-    with TinyDB(db.filepath, storage=db.storage, default_table=db.table_name) as mpm_db:
-        module = Query()
+    module = Query()
+    with db.open_db() as mpm_db:
         db_entry = mpm_db.get(module.name == module_name)
-        if db_entry:
-            click.echo('Uninstalling ' + module_name + '...')
-            full_path = yaml_to_path_helper(db_entry['path'])
-            remove_from_gitignore_helper(db.gitignore_name, full_path)
-            if os.path.exists(full_path):
-                shutil.rmtree(full_path, onerror=onerror_helper)
-            mpm_db.remove(module.name == module_name)
-            if full_path != module_name:
-                if not os.listdir(full_path.split(module_name)[0]):
-                    os.rmdir(full_path.split(module_name)[0])
-            click.echo('Uninstall complete!')
-        else:
-            click.echo('Nothing to uninstall!')
+    if db_entry:
+        full_path = yaml_to_path_helper(db_entry['path'])
+        with db.lock_module(full_path):
+            with db.open_db() as mpm_db:
+                if not mpm_db.get(module.name == module_name):
+                    # Uninstalled by another process while waiting
+                    click.echo('Nothing to uninstall!')
+                    return
+                click.echo('Uninstalling ' + module_name + '...')
+                remove_from_gitignore_helper(db.gitignore_name, full_path)
+                store_path = linked_store_helper(full_path)
+                if store_path:
+                    unlink_store_module_helper(store_path, full_path, db.trash_path, db.lock_timeout)
+                elif os.path.exists(full_path):
+                    move_to_trash_helper(full_path, db.trash_path)
+                mpm_db.remove(module.name == module_name)
+                clear_journal_helper(db.journal_path, full_path)
+                if full_path != module_name:
+                    if not os.listdir(full_path.split(module_name)[0]):
+                        os.rmdir(full_path.split(module_name)[0])
+        if reap:
+            reap_trash_helper(db.trash_path, background)
+        click.echo('Uninstall complete!')
+    else:
+        click.echo('Nothing to uninstall!')
 
 
-def mpm_update(db, module_name, reference, directory):
+def mpm_update(db, module_name, reference, directory, sparse=None, checkout=None):
     """
     Update a module's git reference and update the database entry.
     Additionally, the directory of the module can be moved if
-    a new directory is entered.
+    a new directory is entered, its sparse checkout directories
+    replaced if a new list is entered, and its checkout settings
+    overridden by the checkout dict. The module's sparse checkout
+    and checkout settings are re-applied on every update.
     If no module is found in the database, nothing is updated.
+    The module path stays locked while it is checked out or moved.
+    The remote is always listed again rather than trusting the
+    remote refs cache, so the newest commit is checked out.
     """
-    with TinyDB(db.filepath, storage=db.storage, default_table=db.table_name) as mpm_db:
-        module = Query()
+    module = Query()
+    with db.open_db() as mpm_db:
         item = mpm_db.get(module.name == module_name)
-        if item:
+    if item:
+        path = yaml_to_path_helper(item['path'])
+        with db.lock_module(path):
+            with db.open_db() as mpm_db:
+                item = mpm_db.get(module.name == module_name)
+            if not item or yaml_to_path_helper(item['path']) != path:
+                raise click.ClickException('Module ' + module_name + ' was changed by another mpm process, try again.')
             if not reference:
                 # Pull up to latest commit on active branch
                 reference = item['reference']
+            if sparse is None:
+                sparse = item.get('sparse')
+            merged_checkout = dict(item.get('checkout') or {})
+            merged_checkout.update(checkout or {})
+            checkout_config_helper(merged_checkout)
             click.echo('Updating ' + module_name + '...')
-            clone_and_checkout_helper(item['remote_url'], reference, yaml_to_path_helper(item['path']))
-            mpm_db.update({'reference': reference}, module.name == module_name)
+            recover_module_helper(db.journal_path, db.trash_path, path, item['remote_url'])
+            refs = cached_ls_remote_all_helper([item['remote_url']], db.remote_cache_path, 0, host_slot=db.host_slot).get(item['remote_url'])
+            remote_sha = resolve_reference_helper(refs or {}, reference)
+            with db.host_slot(item['remote_url']):
+                db.clone_and_checkout(item['remote_url'], reference, path, remote_sha, sparse, merged_checkout, db.journal(path, module_name, item['remote_url'], reference))
+            with db.open_db() as mpm_db:
+                mpm_db.update({'reference': reference}, module.name == module_name)
+                if sparse and list(sparse) != item.get('sparse'):
+                    mpm_db.update({'sparse': list(sparse)}, module.name == module_name)
+                elif not sparse and 'sparse' in item:
+                    mpm_db.update(delete('sparse'), module.name == module_name)
+                if merged_checkout != (item.get('checkout') or {}):
+                    mpm_db.update({'checkout': merged_checkout}, module.name == module_name)
+            clear_journal_helper(db.journal_path, path)
             click.echo('Module reference updated!')
 
             if directory:
                 new_path = os.path.join(directory, module_name)
-                if new_path != yaml_to_path_helper(item['path']):
-                    if not os.path.exists(directory):
-                        os.mkdir(directory)
-                    os.rename(yaml_to_path_helper(item['path']), new_path)
-                    mpm_db.update({'path': path_to_yaml_helper(new_path)}, module.name == module_name)
+                if new_path != path:
+                    with db.lock_module(new_path):
+                        if not os.path.exists(directory):
+                            os.mkdir(directory)
+                        store_path = linked_store_helper(path)
+                        if store_path:
+                            move_store_module_helper(store_path, path, new_path, db.lock_timeout)
+                        else:
+                            os.rename(path, new_path)
+                        with db.open_db() as mpm_db:
+                            mpm_db.update({'path': path_to_yaml_helper(new_path)}, module.name == module_name)
                     click.echo('Module directory updated!')
+    else:
+        click.echo('Module not found!')
+
+def mpm_update_all(db, pattern=None, ttl=0):
+    """
+    Update every module in the database, or only the modules whose
+    name or path matches the glob pattern, to the latest commit of
+    their reference. Each unique remote is queried once, and only
+    the modules whose resolved SHA changed are fetched and checked
+    out. Refs of a remote queried less than ttl seconds ago are
+    reused, but only while they point past the checked out commit,
+    as refs that do not may be stale; such remotes are queried again.
+    If no module matches, nothing is updated.
+    """
+    with db.open_db() as mpm_db:
+        items = [item for item in mpm_db.all() if not pattern or fnmatch.fnmatch(item['name'], pattern) or fnmatch.fnmatch(item['path'], pattern)]
+    if not items:
+        click.echo('Module not found!')
+        return
+
+    click.echo('Resolving references for ' + str(len(items)) + ' modules...')
+    remote_refs = cached_ls_remote_all_helper((item['remote_url'] for item in items), db.remote_cache_path, ttl, host_slot=db.host_slot)
+    if ttl:
+        stale = set()
+        for item in items:
+            path = yaml_to_path_helper(item['path'])
+            cached_sha = resolve_reference_helper(remote_refs.get(item['remote_url']) or {}, item['reference'])
+            if cached_sha and os.path.exists(os.path.join(path, '.git')) and is_ancestor_helper(path, cached_sha, head_sha_helper(path)):
+                stale.add(item['remote_url'])
+        remote_refs.update(cached_ls_remote_all_helper(stale, db.remote_cache_path, 0, host_slot=db.host_slot))
+    updated = []
+    for item in items:
+        path = yaml_to_path_helper(item['path'])
+        reference = item['reference']
+        refs = remote_refs.get(item['remote_url'])
+        if refs is None:
+            click.echo('WARNING: could not list remote ' + item['remote_url'] + ', updating ' + item['name'] + ' anyway.')
+        new_sha = resolve_reference_helper(refs or {}, reference)
+        with db.lock_module(path):
+            recover_module_helper(db.journal_path, db.trash_path, path, item['remote_url'])
+            old_sha = None
+            if os.path.exists(os.path.join(path, '.git')):
+                old_sha = head_sha_helper(path)
+            if old_sha and (old_sha == new_sha or (is_sha_helper(reference) and old_sha.startswith(reference))):
+                continue
+            click.echo('Updating ' + item['name'] + '...')
+            with db.host_slot(item['remote_url']):
+                db.clone_and_checkout(item['remote_url'], reference, path, new_sha, item.get('sparse'), item.get('checkout'), db.journal(path, item['name'], item['remote_url'], reference))
+            clear_journal_helper(db.journal_path, path)
+            updated.append((item['name'], old_sha, head_sha_helper(path)))
+
+    for name, old_sha, new_sha in updated:
+        if old_sha != new_sha:
+            click.echo('{}: {} -> {}'.format(name, old_sha[:7] if old_sha else 'missing', new_sha[:7]))
+    click.echo(str(len(updated)) + ' updated, ' + str(len(items) - len(updated)) + ' already up to date.')
+
+def mpm_outdated(db, ttl=REMOTE_CACHE_TTL):
+    """
+    Lists the modules whose checked out commit differs from the
+    commit their reference points to upstream, without fetching or
+    touching any working tree. Each unique remote is queried once,
+    unless it was queried less than ttl seconds ago.
+    """
+    with db.open_db() as mpm_db:
+        items = mpm_db.all()
+    if not items:
+        click.echo('No modules installed!')
+        return
+
+    remote_refs = cached_ls_remote_all_helper((item['remote_url'] for item in items), db.remote_cache_path, ttl, host_slot=db.host_slot)
+    rows = []
+    for item in items:
+        path = yaml_to_path_helper(item['path'])
+        recorded = head_sha_helper(path) if os.path.exists(os.path.join(path, '.git')) else None
+        refs = remote_refs.get(item['remote_url'])
+        upstream = resolve_reference_helper(refs or {}, item['reference'])
+        if is_sha_helper(item['reference']) and recorded and recorded.startswith(item['reference']):
+            continue
+        if recorded != upstream or not recorded:
+            rows.append((item['name'], item['reference'], recorded[:7] if recorded else 'missing', upstream[:7] if upstream else 'unknown'))
+
+    if rows:
+        rows.insert(0, ('name', 'reference', 'recorded', 'upstream'))
+        widths = [max(len(row[column]) for row in rows) for column in range(4)]
+        for row in rows:
+            click.echo('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+    else:
+        click.echo('All modules up to date!')
+
+def mpm_prefetch(db, jobs=4, ttl=PREFETCH_TTL, pattern=None):
+    """
+    Fetches new objects for every installed module, or only the
+    modules whose name or path matches the glob pattern, into hidden
+    refs, without touching their working trees. Up to jobs modules
+    are fetched at once, and modules prefetched less than ttl seconds
+    ago are skipped. The prefetched refs also refresh the remote refs
+    cache, so a following update resolves and checks out the new
+    commits from local objects. Modules linked from a store are
+    skipped, as new commits get new store entries.
+    """
+    with db.open_db() as mpm_db:
+        items = [item for item in mpm_db.all() if not pattern or fnmatch.fnmatch(item['name'], pattern) or fnmatch.fnmatch(item['path'], pattern)]
+    items = [item for item in items if os.path.exists(os.path.join(yaml_to_path_helper(item['path']), '.git')) and not linked_store_helper(yaml_to_path_helper(item['path']))]
+    now = time.time()
+    due = [item for item in items if now - (prefetch_time_helper(yaml_to_path_helper(item['path'])) or 0) >= ttl]
+    if not due:
+        click.echo('Nothing to prefetch!' if not items else 'All ' + str(len(items)) + ' modules were prefetched recently.')
+        return
+
+    def prefetch(item):
+        path = yaml_to_path_helper(item['path'])
+        with db.lock_module(path), db.host_slot(item['remote_url']):
+            try:
+                return prefetch_repo_helper(path)
+            except GitCommandError:
+                return None
+
+    click.echo('Prefetching ' + str(len(due)) + ' modules...')
+    pool = ThreadPool(max(1, min(jobs, len(due))))
+    try:
+        results = pool.map(prefetch, due)
+    finally:
+        pool.close()
+        pool.join()
+
+    cache = read_remote_cache_helper(db.remote_cache_path)
+    for item, refs in zip(due, results):
+        if refs is None:
+            click.echo('WARNING: could not prefetch ' + item['name'] + ' from ' + item['remote_url'] + '.')
         else:
-            click.echo('Module not found!')
+            cache[item['remote_url']] = {'time': now, 'refs': refs}
+    write_remote_cache_helper(db.remote_cache_path, cache)
+    failed = results.count(None)
+    click.echo('{} prefetched, {} fresh, {} failed.'.format(len(due) - failed, len(items) - len(due), failed))
 
-def mpm_load(db, filename, product):
+def mpm_load(db, filename, products, resume=False, product_dbs=False):
     """
     Installs a module set from a previously created yaml
-    file and updates the database. The product string specifies
-    which configuration to load within the yaml file, as multiple
-    products can be supported per file. If the product does not
-    exist in the file, nothing will be loaded.
+    file and updates the database. The products list specifies
+    which configurations to load within the yaml file, as multiple
+    products can be supported per file, and None loads all of them.
+    The file is read in a single pass. For one product, each module
+    is installed as soon as its entry is parsed. For several, the
+    union of their entries is gathered first, and if two products pin
+    a module differently, install two modules to the same path, or
+    any of them has no modules in the file, the load fails before
+    anything is installed. Each module is then installed once. If a
+    single product does not exist in the file, nothing will be
+    loaded. With resume, a load that was interrupted is finished:
+    modules it already installed are skipped without any checks, and
+    the modules it left unfinished are resumed from their journal.
+    With product_dbs, a working database of the modules of each
+    product is also written to the products directory next to the
+    database, without any more git work.
     """
     if os.path.exists(filename):
-        with TinyDB(filename, storage=db.storage, default_table=product) as load_db:
-            if load_db.all():
-                click.echo('Loading modules from file: ' + filename + '...')
-                for item in load_db.all():
-                    name = item['name']
-                    directory = yaml_to_path_helper(item['path']).split(os.path.sep)[-2]
-                    mpm_install(db, item['remote_url'], item['reference'], directory, name)
-                click.echo('Load complete!')
-            else:
-                load_db.purge_table(product)
-                click.echo('Nothing to load!')
+        if products is not None and not isinstance(products, (list, tuple)):
+            products = [products]
+        single = products is not None and len(products) == 1
+        product_entries = OrderedDict()
+        entries = stream_manifest_products_helper(filename, products)
+        if not single:
+            modules = OrderedDict()
+            paths = {}
+            conflicts = []
+            for product, item in entries:
+                product_entries.setdefault(product, []).append(item)
+                name = item['name']
+                if name in modules:
+                    other_product, other = modules[name]
+                    keys = [key for key in ['remote_url', 'reference', 'path', 'sparse', 'checkout'] if other.get(key) != item.get(key)]
+                    if keys:
+                        conflicts.append('{} is pinned to {} by {}, but to {} by {}'.format(
+                            name, ', '.join('{} {}'.format(key, other.get(key)) for key in keys), other_product,
+                            ', '.join('{} {}'.format(key, item.get(key)) for key in keys), product))
+                elif item['path'] in paths:
+                    conflicts.append('{} and {} are both installed to {}, by {} and {}'.format(
+                        paths[item['path']][1], name, item['path'], paths[item['path']][0], product))
+                else:
+                    modules[name] = (product, item)
+                    paths[item['path']] = (product, name)
+            if conflicts:
+                raise click.ClickException('The products pin modules differently:\n  ' + '\n  '.join(conflicts))
+            missing = [product for product in products or [] if product not in product_entries]
+            if missing:
+                raise click.ClickException('No modules found in ' + filename + ' for products: ' + ', '.join(missing))
+            if modules:
+                click.echo('Loading {} modules of {} from file: {}...'.format(len(modules), ', '.join(product_entries), filename))
+            entries = modules.values()
+
+        loaded = False
+        installed = {}
+        if resume:
+            with db.open_db() as mpm_db:
+                installed = dict((entry['name'], entry) for entry in mpm_db.all())
+        skipped = 0
+        for product, item in entries:
+            if not loaded:
+                if single:
+                    click.echo('Loading modules from file: ' + filename + '...')
+                loaded = True
+            if single and product_dbs:
+                product_entries.setdefault(product, []).append(item)
+            name = item['name']
+            entry = installed.get(name)
+            if (entry and all(entry.get(key) == item.get(key) for key in ['remote_url', 'reference', 'path'])
+                    and not read_journal_helper(db.journal_path, yaml_to_path_helper(entry['path']))
+                    and os.path.exists(os.path.join(yaml_to_path_helper(entry['path']), '.git'))):
+                skipped += 1
+                continue
+            # Empty for a module at the top level of the workspace
+            directory = os.path.dirname(yaml_to_path_helper(item['path']))
+            mpm_install(db, item['remote_url'], item['reference'], directory, name, item.get('sparse'), item.get('checkout'), resume)
+        if skipped:
+            click.echo('Skipped ' + str(skipped) + ' modules already loaded.')
+        if product_dbs:
+            for product, items in product_entries.items():
+                product_filepath = os.path.join(os.path.dirname(db.filepath), 'products', product, os.path.basename(db.filepath))
+                write_product_db_helper(product_filepath, db.storage, db.table_name, items)
+                click.echo('Wrote the working database of ' + product + ' to ' + product_filepath + '.')
+        if loaded:
+            click.echo('Load complete!')
+        else:
+            click.echo('Nothing to load!')
     else:
         click.echo('File not found!')
 
@@ -159,14 +617,14 @@ def mpm_freeze(db, filename, product):
     supported per file. If no modules are installed, nothing will be
     frozen.
     """
-    with TinyDB(db.filepath, storage=db.storage, default_table=db.table_name) as mpm_db:
+    with db.open_db() as mpm_db:
         if not os.path.isfile(filename):
             with open(filename, 'a'):
                 pass
 
         if mpm_db.all():
             click.echo('Freezing installed modules to file... ' + filename)
-            with TinyDB(filename, storage=db.storage, default_table=product) as save_db:
+            with TinyDB(filename, storage=YAMLStorage, default_table=product) as save_db:
                 for item in mpm_db.all():
                     if item not in save_db.table(product):
                         save_db.table(product).insert(item)
@@ -175,47 +633,211 @@ def mpm_freeze(db, filename, product):
             click.echo('Nothing to freeze!')
             os.remove(filename)
 
-def mpm_purge(db):
+def mpm_purge(db, background=False):
     """
     Deletes all the currently installed modules from the database
     and file system. If the database is empty, nothing will be purged.
+    All module folders are moved to the trash first, then deleted
+    in parallel.
     """
-    with TinyDB(db.filepath, storage=db.storage, default_table=db.table_name) as mpm_db:
-        if mpm_db.all():
-            click.echo('Purging all modules...')
-            for item in mpm_db.all():
-                mpm_uninstall(db, item['name'])
-            click.echo('Purging complete!')
+    with db.open_db() as mpm_db:
+        items = mpm_db.all()
+    if items:
+        click.echo('Purging all modules...')
+        for item in items:
+            mpm_uninstall(db, item['name'], reap=False)
+        reap_trash_helper(db.trash_path, background)
+        click.echo('Purging complete!')
+    else:
+        click.echo('Nothing to purge!')
+
+def mpm_gc(db):
+    """
+    Empties the trash left behind by interrupted or background
+    uninstalls. If a module store is used, its entries no workspace
+    links to anymore are collected too. If the trash is empty,
+    nothing will be collected.
+    """
+    if db.store_path:
+        collected = gc_store_helper(db.store_path, db.trash_path, db.lock_timeout)
+        if collected:
+            click.echo('Collected ' + str(collected) + ' unused store entries.')
+    if os.path.isdir(db.trash_path) and os.listdir(db.trash_path):
+        click.echo('Emptying trash...')
+        reap_trash_helper(db.trash_path)
+        click.echo('Garbage collection complete!')
+    else:
+        click.echo('Nothing to collect!')
+
+def mpm_maintain(db, cpus=None, pattern=None):
+    """
+    Runs repository maintenance (repack, commit-graph and
+    multi-pack-index) on every installed module, or only the modules
+    whose name or path matches the glob pattern. Modules are maintained
+    concurrently within a budget of cpus processors, and the bytes
+    reclaimed and history walk time saved are reported per module.
+    Modules linked from a store are skipped, as other workspaces may
+    be reading their checkouts.
+    """
+    with db.open_db() as mpm_db:
+        items = [item for item in mpm_db.all() if not pattern or fnmatch.fnmatch(item['name'], pattern) or fnmatch.fnmatch(item['path'], pattern)]
+    items = [item for item in items if os.path.exists(os.path.join(yaml_to_path_helper(item['path']), '.git')) and not linked_store_helper(yaml_to_path_helper(item['path']))]
+    if not items:
+        click.echo('Nothing to maintain!')
+        return
+
+    if not cpus:
+        cpus = max(1, multiprocessing.cpu_count() // 2)
+    workers = min(cpus, len(items))
+    threads = max(1, cpus // workers)
+
+    def maintain(item):
+        path = yaml_to_path_helper(item['path'])
+        with db.lock_module(path):
+            return maintain_repo_helper(path, threads)
+
+    click.echo('Maintaining ' + str(len(items)) + ' modules on ' + str(cpus) + ' CPUs...')
+    pool = ThreadPool(workers)
+    try:
+        results = pool.map(maintain, items)
+    finally:
+        pool.close()
+        pool.join()
+
+    for item, result in zip(items, results):
+        click.echo('{}: reclaimed {} in {:.1f}s, history walk {:.3f}s -> {:.3f}s'.format(
+            item['name'], format_bytes_helper(result['reclaimed']), result['duration'], result['walk_before'], result['walk_after']))
+    click.echo('Reclaimed ' + format_bytes_helper(sum(result['reclaimed'] for result in results)) + ' in total.')
+    click.echo('Maintenance complete!')
+
+def mpm_doctor(db, perf=False, output_format='table', fetch=True):
+    """
+    Checks every module in the database for missing checkouts,
+    unfinished operations and links to collected store entries.
+    With perf, every module's repo is measured instead, including a
+    no-op fetch unless fetch is False, and the modules are ranked by
+    the seconds their fetch and status take, most expensive first,
+    with the remedies that apply to each. The report is printed as
+    a table or as JSON.
+    """
+    with db.open_db() as mpm_db:
+        items = mpm_db.all()
+    if not perf:
+        problems = []
+        for item in items:
+            path = yaml_to_path_helper(item['path'])
+            if read_journal_helper(db.journal_path, path):
+                problems.append({'name': item['name'], 'problem': 'an operation did not finish, run mpm load --resume or mpm install again'})
+            elif os.path.islink(path) and not os.path.exists(path):
+                problems.append({'name': item['name'], 'problem': 'its store entry was collected, run mpm install again'})
+            elif not os.path.exists(os.path.join(path, '.git')):
+                problems.append({'name': item['name'], 'problem': 'it is not checked out, run mpm install again'})
+        if output_format == 'json':
+            click.echo(json.dumps(problems, indent=2, sort_keys=True, separators=(',', ': ')))
+        elif problems:
+            for problem in problems:
+                click.echo(problem['name'] + ': ' + problem['problem'])
         else:
-            click.echo('Nothing to purge!')
+            click.echo('No problems found!')
+        return
+
+    reports = []
+    for item in items:
+        path = yaml_to_path_helper(item['path'])
+        if not os.path.exists(os.path.join(path, '.git')):
+            continue
+        with db.lock_module(path), db.host_slot(item['remote_url']):
+            stats = repo_stats_helper(path, fetch)
+        stats.update({'name': item['name'], 'path': item['path'], 'remedies': perf_remedies_helper(item['name'], stats),
+                      'cost': stats['status_time'] + (stats['fetch_time'] or 0)})
+        reports.append(stats)
+    reports.sort(key=lambda report: report['cost'], reverse=True)
+
+    if output_format == 'json':
+        click.echo(json.dumps(reports, indent=2, sort_keys=True, separators=(',', ': ')))
+        return
+    if not reports:
+        click.echo('No modules installed!')
+        return
+    rows = [('name', 'cost', 'size', 'packs', 'loose', 'graph', 'refs', 'remotes', 'files', 'fetch', 'status')]
+    for report in reports:
+        rows.append((report['name'], '{:.2f}s'.format(report['cost']), format_bytes_helper(report['size']), str(report['packs']), str(report['loose']),
+                     'yes' if report['commit_graph'] else 'no', str(report['refs']), str(report['remotes']), str(report['files']),
+                     '{:.2f}s'.format(report['fetch_time']) if report['fetch_time'] is not None else '-', '{:.2f}s'.format(report['status_time'])))
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+    for row in rows:
+        click.echo('  '.join(value.ljust(width) if column == 0 else value.rjust(width) for column, (value, width) in enumerate(zip(row, widths))))
+    for report in reports:
+        if report['remedies']:
+            click.echo('\n' + report['name'] + ':')
+            for remedy in report['remedies']:
+                click.echo('  - ' + remedy)
 
 def mpm_convert(db, filename, product, hard):
     """
     Gets existing git submodules from the repository, adds them to
-    the working database, then freezes to an output file. If the hard
-    option is used, mpm will use GitPython to remove all the submodules
-    from git in favour of managing them via mpm instead.
+    the working database, then freezes to an output file. The
+    submodules are read from .gitmodules and the index directly.
+    Existing checkouts are adopted in place and missing ones are
+    cloned concurrently. If the hard option is used, all the
+    submodules are removed from git in one batch in favour of
+    managing them via mpm instead.
     """
-    if os.path.isfile(os.path.join(os.getcwd(), '.gitmodules')):
-        submodules = Repo(os.getcwd()).submodules
+    repo_path = os.getcwd()
+    if os.path.isfile(os.path.join(repo_path, '.gitmodules')):
+        submodules = read_gitmodules_helper(repo_path)
         if submodules:
             click.echo('Converting all git submodules to mpm modules...')
-            modules = []
             for submodule in submodules:
-                submodule.update(init=True)
-                name = os.path.basename(submodule.path)
-                if name != submodule.path:
-                    directory = submodule.path.split(name)[0].strip(os.path.sep)
-                else:
-                    directory = name
-                remote_url = submodule.url
-                reference = str(submodule.module().head.commit)
-                mpm_install(db, remote_url, reference, directory, name)
-                if hard:
-                    # move the file so GitPython doesn't delete it from the filsystem
-                    os.rename(directory, 'mpm_tmp_mv' + directory)
-                    submodule.remove(configuration=True)
-                    os.rename('mpm_tmp_mv' + directory, directory)
+                recover_module_helper(db.journal_path, db.trash_path, submodule['path'], submodule['url'])
+            shas = gitlink_shas_helper(repo_path, [submodule['path'] for submodule in submodules])
+            checked_out = [submodule for submodule in submodules if os.path.exists(os.path.join(submodule['path'], '.git'))]
+            missing = [submodule for submodule in submodules if submodule not in checked_out and submodule['path'] in shas]
+            for submodule in submodules:
+                if submodule not in checked_out and submodule not in missing:
+                    click.echo('WARNING: ' + submodule['path'] + ' is not checked out or in the index, skipping.')
+            submodules = checked_out + missing
+            if missing:
+                click.echo('Initializing ' + str(len(missing)) + ' submodules...')
+
+                def initialize(submodule):
+                    with db.lock_module(submodule['path']), db.host_slot(submodule['url']):
+                        clone_and_checkout_helper(submodule['url'], shas[submodule['path']], submodule['path'], journal=db.journal(submodule['path'], os.path.basename(submodule['path']), submodule['url'], shas[submodule['path']]))
+
+                pool = ThreadPool(min(MAX_OPEN_REPOS, len(missing)))
+                try:
+                    pool.map(initialize, missing)
+                finally:
+                    pool.close()
+                    pool.join()
+
+            with db.open_db() as mpm_db:
+                module = Query()
+                new_db_entries = []
+                for submodule in submodules:
+                    path = submodule['path']
+                    name = os.path.basename(path)
+                    if hard:
+                        detach_submodule_gitdir_helper(path)
+                    add_to_gitignore_helper(db.gitignore_name, path)
+                    db_entry = {'name': name, 'remote_url': submodule['url'], 'reference': head_sha_helper(path), 'path': path_to_yaml_helper(path)}
+                    if mpm_db.get(module.name == name):
+                        mpm_db.update(db_entry, module.name == name)
+                    else:
+                        new_db_entries.append(db_entry)
+                mpm_db.insert_multiple(new_db_entries)
+            for submodule in submodules:
+                clear_journal_helper(db.journal_path, submodule['path'])
+
+            if hard:
+                paths = [submodule['path'] for submodule in submodules if submodule['path'] in shas]
+                sections = ['submodule "' + submodule['name'] + '"' for submodule in submodules]
+                git = Git(repo_path)
+                if paths:
+                    git.execute(['git', 'rm', '--cached', '-q', '--'] + paths)
+                remove_config_sections_helper(os.path.join(repo_path, '.gitmodules'), sections)
+                remove_config_sections_helper(os.path.join(repo_path, git.execute(['git', 'rev-parse', '--git-dir']), 'config'), sections)
+                git.execute(['git', 'add', '.gitmodules'])
 
             mpm_freeze(db, filename, product)
             click.echo('Convert complete!')
@@ -228,7 +850,7 @@ def mpm_show(db):
     """
     Displays all currently installed modules in the database.
     """
-    with TinyDB(db.filepath, storage=db.storage, default_table=db.table_name) as mpm_db:
+    with db.open_db() as mpm_db:
         if mpm_db.all():
             click.echo('\nmodules installed')
         else:
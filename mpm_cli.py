@@ -1,43 +1,90 @@
 import click
 
-from mpm import MPMMetadata, mpm_init, mpm_install, mpm_uninstall, mpm_update, mpm_load, mpm_freeze, mpm_purge, mpm_convert, mpm_show
+from mpm_daemon import DAEMON_SOCKET, serve_daemon, stop_daemon
+from mpm import DB_STORAGES, REMOTE_CACHE_TTL, PREFETCH_TTL, MPMMetadata, mpm_init, mpm_install, mpm_uninstall, mpm_update, mpm_update_all, mpm_outdated, mpm_prefetch, mpm_load, mpm_freeze, mpm_purge, mpm_gc, mpm_maintain, mpm_doctor, mpm_convert, mpm_show
 
 pass_db = click.make_pass_decorator(MPMMetadata)
 
 @click.group()
+@click.option('--storage', type=click.Choice(sorted(DB_STORAGES)), default=None, envvar='MPM_STORAGE', help='The storage type of a new working module database. An existing database keeps its storage type unless --migrate-storage is given.  [default: yaml]')
+@click.option('--migrate-storage', is_flag=True, help='Migrate an existing working module database to the storage type selected with --storage.')
+@click.option('--lock-timeout', type=float, default=None, envvar='MPM_LOCK_TIMEOUT', help='Seconds to wait for modules or the database locked by another mpm process. Use 0 to fail fast. Waits indefinitely by default.')
+@click.option('--max-per-host', type=int, show_default=True, default=8, envvar='MPM_MAX_PER_HOST', help='The maximum number of concurrent network operations against one git host, across all mpm processes in the workspace. Use 0 for no limit.')
+@click.option('--ssh-multiplexing/--no-ssh-multiplexing', show_default=True, default=True, envvar='MPM_SSH_MULTIPLEXING', help='Share one SSH connection per host between the git processes of a command. Skipped if a custom ssh command is configured.')
+@click.option('--store', type=click.Path(file_okay=False), default=None, envvar='MPM_STORE', help='Install new modules as links into this module store, shared by all workspaces, which holds one read only checkout per commit.')
 @click.pass_context
-def cli(ctx):
-    mpm_init(ctx)
+def cli(ctx, storage, migrate_storage, lock_timeout, max_per_host, ssh_multiplexing, store):
+    if migrate_storage and not storage:
+        raise click.UsageError('--migrate-storage needs the storage type to migrate to, given with --storage.')
+    db_storage, db_filename = DB_STORAGES[storage] if storage else (None, None)
+    mpm_init(ctx, db_filename=db_filename, db_storage=db_storage, lock_timeout=lock_timeout, host_limit=max_per_host or None, store_path=store, migrate=migrate_storage, ssh_multiplexing=ssh_multiplexing)
 
 @cli.command(help='Retrieve and install a module.')
 @click.argument('remote_url', required=True)
 @click.option('-r', '--reference', show_default=True, default='remotes/origin/master', help='The upstream remote SHA of the module you want to checkout.')
 @click.option('-d', '--directory', show_default=True, default='modules', help='Select the folder to install the module in.')
 @click.option('-n', '--name', show_default=True, default=None, help='Customize the folder name of the module. Useful in the event of name collisions. If no name is included, the name will be extracted from the remote URL.')
+@click.option('-s', '--sparse', multiple=True, help='Only checkout this directory of the module. Can be repeated.')
+@click.option('-w', '--checkout-workers', type=int, default=None, help='The number of parallel checkout workers of the module. Use 0 for one per CPU.  [default: 0]')
 @pass_db
-def install(db, remote_url, reference, directory, name):
-    mpm_install(db, remote_url, reference, directory, name)
+def install(db, remote_url, reference, directory, name, sparse, checkout_workers):
+    checkout = {'workers': checkout_workers} if checkout_workers is not None else None
+    mpm_install(db, remote_url, reference, directory, name, list(sparse), checkout)
 
 @cli.command(help='Uninstall a module.')
 @click.argument('module_name', required=True)
+@click.option('-b', '--background', is_flag=True, help='Delete the module files in a detached background process and return immediately.')
 @pass_db
-def uninstall(db, module_name):
-    mpm_uninstall(db, module_name)
+def uninstall(db, module_name, background):
+    mpm_uninstall(db, module_name, background)
 
 @cli.command(help='Update a modules reference or install path.')
-@click.argument('module_name', required=True)
+@click.argument('module_name', required=False)
 @click.option('-r', '--reference', show_default=True, default=None, help='The upstream remote SHA of the module you want to checkout.')
 @click.option('-d', '--directory', show_default=True, default=None, help='Select the folder to move the module to.')
+@click.option('-a', '--all', 'update_all', is_flag=True, help='Update every installed module to the latest commit of its reference.')
+@click.option('-f', '--filter', 'pattern', default=None, help='Update only the modules whose name or path matches this glob pattern.')
+@click.option('-s', '--sparse', multiple=True, help='Replace the directories of the module to checkout. Can be repeated.')
+@click.option('--no-sparse', is_flag=True, help='Checkout the full module again.')
+@click.option('-w', '--checkout-workers', type=int, default=None, help='Change the number of parallel checkout workers of the module. Use 0 for one per CPU.')
+@click.option('-t', '--ttl', type=float, show_default=True, default=0, help='With --all or --filter, reuse remote refs listed less than this many seconds ago while they point past the checked out commit.')
+@pass_db
+def update(db, module_name, reference, directory, update_all, pattern, sparse, no_sparse, checkout_workers, ttl):
+    if update_all or pattern:
+        if module_name or reference or directory or sparse or no_sparse or checkout_workers is not None:
+            raise click.UsageError('--all and --filter cannot be combined with MODULE_NAME, --reference, --directory, --sparse or --checkout-workers.')
+        mpm_update_all(db, pattern, ttl)
+    elif module_name:
+        checkout = {'workers': checkout_workers} if checkout_workers is not None else None
+        mpm_update(db, module_name, reference, directory, [] if no_sparse else (list(sparse) or None), checkout)
+    else:
+        raise click.UsageError('Missing argument MODULE_NAME, or use --all or --filter.')
+
+@cli.command(help='List modules whose checked out commit differs from their reference upstream.')
+@click.option('-t', '--ttl', type=float, show_default=True, default=REMOTE_CACHE_TTL, help='Reuse remote refs listed less than this many seconds ago.')
 @pass_db
-def update(db, module_name, reference, directory):
-    mpm_update(db, module_name, reference, directory)
+def outdated(db, ttl):
+    mpm_outdated(db, ttl)
+
+@cli.command(help='Fetch new commits of installed modules in the background, without touching their working trees, so later updates run from local objects.')
+@click.option('-j', '--jobs', type=int, show_default=True, default=4, help='The number of modules to fetch at once.')
+@click.option('-t', '--ttl', type=float, show_default=True, default=PREFETCH_TTL, help='Skip modules prefetched less than this many seconds ago.')
+@click.option('-f', '--filter', 'pattern', default=None, help='Prefetch only the modules whose name or path matches this glob pattern.')
+@pass_db
+def prefetch(db, jobs, ttl, pattern):
+    mpm_prefetch(db, jobs, ttl, pattern)
 
 @cli.command(help='Load and install modules from a yaml file.')
 @click.argument('filename', default='package.yaml', required=True)
-@click.option('-p', '--product', show_default=True, default='_default', help='The configuration name to load the modules from.')
+@click.option('-p', '--product', 'products', multiple=True, help='The configuration name to load the modules from. Can be repeated to load several products in one pass.  [default: _default]')
+@click.option('--all-products', is_flag=True, help='Load the modules of every product in the file.')
+@click.option('--product-dbs', is_flag=True, help='Also write a working database of the modules of each product to .mpm/products/PRODUCT/.')
+@click.option('--resume', is_flag=True, help='Finish an interrupted load, skipping the modules it already installed.')
 @pass_db
-def load(db, filename, product):
-    mpm_load(db, filename, product)
+def load(db, filename, products, all_products, product_dbs, resume):
+    if all_products and products:
+        raise click.UsageError('--all-products cannot be combined with --product.')
+    mpm_load(db, filename, None if all_products else (list(products) or ['_default']), resume, product_dbs)
 
 @cli.command(help='Save installed modules to a yaml file.')
 @click.argument('filename', default='package.yaml', required=True)
@@ -47,9 +94,30 @@ def freeze(db, filename, product):
     mpm_freeze(db, filename, product)
 
 @cli.command(help='Uninstall all modules.')
+@click.option('-b', '--background', is_flag=True, help='Delete the module files in a detached background process and return immediately.')
+@pass_db
+def purge(db, background):
+    mpm_purge(db, background)
+
+@cli.command(help='Delete leftover files from interrupted or background uninstalls.')
 @pass_db
-def purge(db):
-    mpm_purge(db)
+def gc(db):
+    mpm_gc(db)
+
+@cli.command(help='Repack installed modules and write commit-graphs and multi-pack-indexes.')
+@click.option('-c', '--cpus', type=int, default=None, help='The number of CPUs maintenance may use.  [default: half of the available CPUs]')
+@click.option('-f', '--filter', 'pattern', default=None, help='Maintain only the modules whose name or path matches this glob pattern.')
+@pass_db
+def maintain(db, cpus, pattern):
+    mpm_maintain(db, cpus, pattern)
+
+@cli.command(help='Check installed modules for problems, or with --perf, find the modules that slow the workspace down.')
+@click.option('--perf', is_flag=True, help='Measure every module and rank them by the time their fetch and status take, with suggested remedies.')
+@click.option('--format', 'output_format', type=click.Choice(['table', 'json']), show_default=True, default='table', help='Print the report as a table or as JSON.')
+@click.option('--no-fetch', is_flag=True, help='Do not time a fetch of every module, so no network is used.')
+@pass_db
+def doctor(db, perf, output_format, no_fetch):
+    mpm_doctor(db, perf, output_format, not no_fetch)
 
 @cli.command(help='Gets existing git submodules from the repository, adds them to the working set, then freezes to an output file.')
 @click.argument('filename', default='package.yaml', required=True)
@@ -63,3 +131,16 @@ def convert(db, filename, product, hard):
 @pass_db
 def show(db):
     mpm_show(db)
+
+@cli.command(help='Serve mpm commands for this workspace from a long running process. The mpm command uses the daemon automatically while it is running.')
+@click.option('-t', '--idle-timeout', type=float, default=None, help='Stop after this many seconds without a request.')
+@click.option('--stop', is_flag=True, help='Stop the daemon running in this workspace.')
+@click.pass_context
+def daemon(ctx, idle_timeout, stop):
+    if stop:
+        if stop_daemon(DAEMON_SOCKET):
+            click.echo('mpm daemon stopped.')
+        else:
+            click.echo('No mpm daemon running!')
+    else:
+        serve_daemon(ctx.find_root().command, DAEMON_SOCKET, idle_timeout)
@@ -0,0 +1,203 @@
+import json
+import os
+import socket
+import sys
+import traceback
+import click
+
+DAEMON_SOCKET = os.path.join('.mpm', 'mpm.sock')
+
+# Commands the daemon serves, with the options that make them run in
+# the client instead. Served commands only read the workspace and
+# finish quickly, as the daemon serves one request at a time. The
+# others, like outdated and doctor --perf which reach every remote,
+# run in the client, where their output is streamed, they can prompt
+# for credentials and Ctrl-C stops them.
+DAEMON_COMMANDS = {
+    'show': [],
+    'doctor': ['--perf'],
+}
+
+def send_message(connection, message):
+    """
+    Sends a message as a single line of JSON.
+    """
+    connection.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+def receive_message(connection):
+    """
+    Receives a single line of JSON and decodes it. Raises
+    ValueError if the connection closes before a full message.
+    """
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = connection.recv(65536)
+        if not chunk:
+            raise ValueError('Connection closed before a full message was received.')
+        data += chunk
+    return json.loads(data.decode('utf-8'))
+
+def is_daemon_running(socket_path=DAEMON_SOCKET):
+    """
+    Tests if a daemon is accepting connections on socket_path.
+    """
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+        return False
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        client.close()
+
+def is_daemon_command(command, argv):
+    """
+    Tests if argv invokes one of the DAEMON_COMMANDS of the click
+    group command, without any of the options that make it run in
+    the client. Returns False if argv does not parse.
+    """
+    try:
+        ctx = command.make_context('mpm', list(argv), resilient_parsing=True)
+    except click.ClickException:
+        return False
+    args = ctx.protected_args + ctx.args
+    if not args or args[0] not in DAEMON_COMMANDS:
+        return False
+    return not any(option in args[1:] for option in DAEMON_COMMANDS[args[0]])
+
+def serve_daemon(command, socket_path=DAEMON_SOCKET, idle_timeout=None):
+    """
+    Serves the click command to mpm clients over a Unix socket,
+    keeping the interpreter, GitPython and parsed YAML files warm
+    between requests. Requests are served one at a time, and only
+    for the DAEMON_COMMANDS of clients running in the workspace the
+    daemon was started in; others are told to fall back to running
+    the command directly. Git never prompts for credentials in the
+    daemon, as nobody would see the prompt. Stops when a client asks
+    it to, or after idle_timeout seconds without a request.
+    """
+    from click.testing import CliRunner
+    from mpm_yaml_storage import YAMLStorage
+
+    if not hasattr(socket, 'AF_UNIX'):
+        raise click.ClickException('The mpm daemon needs Unix domain sockets, which are not supported on this platform.')
+    if is_daemon_running(socket_path):
+        raise click.ClickException('An mpm daemon is already running on ' + socket_path + '.')
+    if os.path.exists(socket_path):
+        # Left behind by a daemon that did not shut down cleanly
+        os.remove(socket_path)
+
+    class DaemonRunner(CliRunner):
+        def get_default_prog_name(self, cli):
+            return 'mpm'
+
+    workspace = os.path.realpath(os.getcwd())
+    runner = DaemonRunner()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(5)
+    server.settimeout(idle_timeout)
+    YAMLStorage.cache = {}
+    terminal_prompt = os.environ.get('GIT_TERMINAL_PROMPT')
+    os.environ['GIT_TERMINAL_PROMPT'] = '0'
+    click.echo('mpm daemon serving ' + workspace + ' on ' + socket_path)
+    try:
+        while True:
+            try:
+                connection = server.accept()[0]
+            except socket.timeout:
+                click.echo('Idle timeout reached, stopping.')
+                break
+            connection.settimeout(None)
+            try:
+                request = receive_message(connection)
+                if request.get('stop'):
+                    send_message(connection, {'stopped': True})
+                    break
+                if os.path.realpath(request.get('cwd', '')) != workspace or not is_daemon_command(command, request['argv']):
+                    send_message(connection, {'fallback': True})
+                    continue
+                # Mirror the client's MPM_ environment variables exactly
+                env = dict((key, None) for key in os.environ if key.startswith('MPM_'))
+                env.update(request.get('env', {}))
+                result = runner.invoke(command, request['argv'], env=env)
+                output = result.output
+                if result.exception and not isinstance(result.exception, SystemExit):
+                    output += ''.join(traceback.format_exception(*result.exc_info))
+                send_message(connection, {'output': output, 'exit_code': result.exit_code})
+            except (socket.error, ValueError, KeyError):
+                # Connection probes and malformed requests are dropped
+                pass
+            finally:
+                connection.close()
+    finally:
+        YAMLStorage.cache = None
+        if terminal_prompt is None:
+            os.environ.pop('GIT_TERMINAL_PROMPT', None)
+        else:
+            os.environ['GIT_TERMINAL_PROMPT'] = terminal_prompt
+        server.close()
+        os.remove(socket_path)
+    click.echo('mpm daemon stopped.')
+
+def stop_daemon(socket_path=DAEMON_SOCKET):
+    """
+    Asks the daemon listening on socket_path to stop. Returns
+    False if no daemon was running.
+    """
+    if not is_daemon_running(socket_path):
+        return False
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        send_message(client, {'stop': True})
+        receive_message(client)
+    finally:
+        client.close()
+    return True
+
+def forward_to_daemon(argv, socket_path=DAEMON_SOCKET):
+    """
+    Runs a command through the daemon listening on socket_path.
+    Returns the (output, exit_code) tuple, or None if no daemon is
+    running or it cannot serve this workspace or command, in which
+    case the caller should run the command directly.
+    """
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            client.connect(socket_path)
+        except socket.error:
+            return None
+        env = dict((key, value) for key, value in os.environ.items() if key.startswith('MPM_'))
+        send_message(client, {'argv': argv, 'cwd': os.getcwd(), 'env': env})
+        try:
+            response = receive_message(client)
+        except (socket.error, ValueError):
+            raise click.ClickException('Lost the connection to the mpm daemon, the command may not have completed.')
+    finally:
+        client.close()
+    if response.get('fallback'):
+        return None
+    return response['output'], response['exit_code']
+
+def main():
+    """
+    Console entry point. Runs the command through the mpm daemon
+    of the current workspace if one is running, otherwise runs it
+    directly. The mpm modules are only imported when the command
+    runs directly, so forwarded commands start quickly.
+    """
+    argv = sys.argv[1:]
+    if 'daemon' not in argv:
+        result = forward_to_daemon(argv, DAEMON_SOCKET)
+        if result is not None:
+            output, exit_code = result
+            click.echo(output, nl=False)
+            sys.exit(exit_code)
+    from mpm_cli import cli
+    cli()
@@ -1,26 +1,74 @@
+import hashlib
+import itertools
 import os
+import re
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
 import click
+import yaml
 
-from git import Repo
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from git import Git, GitCommandError, GitConfigParser
 from tinydb import TinyDB
 
-def is_local_commit_helper(repo, reference):
+def is_local_commit_helper(git, reference):
     """
-    Tests if a branch or sha is local.
+    Tests if a branch or sha is local, using the git command wrapper
+    of the repo.
     """
-    if not repo.git.execute(['git', 'branch', '-r', '--contains', reference]):
+    if not git.execute(['git', 'branch', '-r', '--contains', reference]):
         return True
-    for head in repo.heads:
-        if reference == head.name:
-            return True
-    return False
+    return git.execute(['git', 'show-ref', '--verify', '-q', 'refs/heads/' + reference], with_exceptions=False, with_extended_output=True)[0] == 0
+
+# Most repos mpm works on at once across all threads, so that bulk
+# commands keep their open files and git processes bounded
+MAX_OPEN_REPOS = 16
+
+OPEN_REPOS = threading.BoundedSemaphore(MAX_OPEN_REPOS)
 
-def clone_helper(remote_url, path):
+@contextmanager
+def open_repo_helper(path=None):
+    """
+    Opens the repo at path for the duration of the context and
+    yields its git command wrapper. Plain git commands are used
+    rather than GitPython Repo objects, which cache object databases
+    and keep cat-file processes alive until they are collected. At
+    most MAX_OPEN_REPOS repos are open at once, and any persistent
+    git processes started on the wrapper are stopped on exit.
+    """
+    with OPEN_REPOS:
+        git = Git(path)
+        try:
+            yield git
+        finally:
+            git.clear_cache()
+
+def clone_helper(remote_url, path, no_checkout=False):
     """
     Clone helper used by the install and update commands.
-    Uses GitPython to clone a git repo from a given URL.
+    Clones a git repo from a given URL with git clone.
     If a repo at the given path already exists, it won't be
-    recloned. Returns the repo object.
+    recloned. If no_checkout is set, the working tree is left
+    empty so it can be set up before the first checkout.
     """
     if not path:
         raise TypeError("path cannot be NoneType.")
@@ -28,41 +76,645 @@ def clone_helper(remote_url, path):
         raise TypeError("remote_url cannot be NoneType.")
 
     if not os.path.exists(os.path.join(path, '.git')):
-        repo = Repo.clone_from(remote_url, path)
-    else:
-        repo = Repo(path)
-    repo.close()
+        with open_repo_helper() as git:
+            git.execute(['git', 'clone'] + (['--no-checkout'] if no_checkout else []) + ['--', remote_url, path])
 
-def checkout_helper(path, reference):
+def checkout_helper(path, reference, remote_sha=None, journal=None):
     """
     Checkout helper used by the install and update commands.
-    Uses GitPython to checkout a git repo from a given remote
+    Checks out a git repo from a given remote
     reference (SHA or remote). Before checking out a fetch is issued on
     all remote upstream branches to ensure the latest changes
-    are downloaded.
+    are downloaded. The fetch is skipped when the reference is a SHA
+    that already exists locally, or when remote_sha, the commit the
+    reference points to upstream, is known and the reference already
+    resolves to it locally or was prefetched by mpm prefetch. If a
+    journal function is given, the fetched commit is recorded with
+    it.
     """
     if not path:
         raise TypeError("path cannot be NoneType.")
-    repo = Repo(path)
-    repo.git.execute(['git', 'fetch', '--all', '-v'])
+    with open_repo_helper(path) as git:
+        local_sha = None
+        if remote_sha or is_sha_helper(reference):
+            local_sha = local_sha_helper(git, reference)
+        if remote_sha and local_sha != remote_sha and use_prefetched_helper(git, reference, remote_sha):
+            local_sha = remote_sha
+        if not local_sha or (remote_sha and local_sha != remote_sha):
+            git.execute(['git', 'fetch', '--all', '-v'])
+            record_fetch_helper(path)
+            if journal:
+                journal('fetched', local_sha_helper(git, reference))
+
+        if is_local_commit_helper(git, reference):
+            click.echo(('\nWARNING: Your reference is being set to a local branch or commit.\n'
+                        'If you check-in a yaml file containing a local reference,\n'
+                        'it will not be properly resolved when someone reloads the\n'
+                        'yaml file with a fresh clone of the repo. It is suggested you\n'
+                        'only commit local references if you are creating a draft commit.\n'))
+        git.execute(['git', 'checkout', reference])
+
+def sparse_checkout_helper(path, sparse):
+    """
+    Restricts the working tree of the repo at path to the list of
+    directories in sparse, using cone mode sparse checkout. If sparse
+    is empty and the repo uses sparse checkout, the full working tree
+    is restored.
+    """
+    git = Git(path)
+    if sparse:
+        git.execute(['git', 'sparse-checkout', 'init', '--cone'])
+        git.execute(['git', 'sparse-checkout', 'set', '--'] + list(sparse))
+    elif git.execute(['git', 'config', '--bool', 'core.sparseCheckout'], with_exceptions=False) == 'true':
+        git.execute(['git', 'sparse-checkout', 'disable'])
+
+# Checkout settings of a module, and the git config they map to
+CHECKOUT_SETTINGS = OrderedDict([
+    ('workers', ('checkout', 'workers', int)),
+    ('preload_index', ('core', 'preloadIndex', bool)),
+    ('untracked_cache', ('core', 'untrackedCache', bool)),
+])
+
+# Checkout settings of every module, unless overridden per module.
+# Zero workers lets git use one per CPU for large checkouts. The
+# untracked cache speeds up status but slows down checkouts, so it
+# is left to git unless a module enables it.
+CHECKOUT_DEFAULTS = {'workers': 0, 'preload_index': True}
+
+def checkout_config_helper(checkout):
+    """
+    Validates a dict of checkout settings and returns the git config
+    it maps to, as a list of (section, option, value) tuples. Raises
+    a ClickException for unknown settings or values of the wrong type.
+    """
+    config = []
+    for setting, value in sorted((checkout or {}).items()):
+        if setting not in CHECKOUT_SETTINGS:
+            raise click.ClickException('Unknown checkout setting ' + str(setting) + ', expected one of: ' + ', '.join(CHECKOUT_SETTINGS) + '.')
+        section, option, value_type = CHECKOUT_SETTINGS[setting]
+        if type(value) is not value_type:
+            raise click.ClickException('The checkout setting ' + setting + ' must be ' + ('an integer' if value_type is int else 'true or false') + '.')
+        config.append((section, option, str(value).lower()))
+    return config
 
-    if is_local_commit_helper(repo, reference):
-        click.echo(('\nWARNING: Your reference is being set to a local branch or commit.\n'
-                    'If you check-in a yaml file containing a local reference,\n'
-                    'it will not be properly resolved when someone reloads the\n'
-                    'yaml file with a fresh clone of the repo. It is suggested you\n'
-                    'only commit local references if you are creating a draft commit.\n'))
-    repo.git.checkout(reference)
-    repo.close()
+def checkout_settings_helper(path, checkout=None):
+    """
+    Writes the checkout settings, the defaults overridden by the
+    checkout dict, to the config of the repo at path, so they apply
+    to its checkouts from then on. The settings are written with git
+    config, which also finds the config of checkouts whose .git is a
+    file, and only those whose value changed are written.
+    """
+    settings = dict(CHECKOUT_DEFAULTS)
+    settings.update(checkout or {})
+    git = Git(path)
+    for section, option, value in checkout_config_helper(settings):
+        key = section + '.' + option
+        if git.execute(['git', 'config', '--local', '--get', key], with_exceptions=False).lower() != value:
+            git.execute(['git', 'config', '--local', key, value])
 
-def clone_and_checkout_helper(remote_url, reference, path):
+def clone_and_checkout_helper(remote_url, reference, path, remote_sha=None, sparse=None, checkout=None, journal=None):
     """
     Clones and checks out a repo at the given url and reference
     to the provided path. Calls the checkout and clone helpers.
+    If a list of sparse directories is given, sparse checkout is
+    set up before the first checkout, so only those directories
+    are ever written to disk. Likewise the checkout settings,
+    overridden by the checkout dict, are written to the repo's
+    config before its first checkout. If a journal function is
+    given, it is called with each step before moving on, with the
+    start of a clone recorded before anything is written to path.
+    """
+    cloning = not os.path.exists(os.path.join(path, '.git'))
+    if journal and cloning:
+        journal('clone-started')
+    clone_helper(remote_url, path, no_checkout=True)
+    if journal and cloning:
+        journal('cloned')
+    checkout_settings_helper(path, checkout)
+    sparse_checkout_helper(path, sparse)
+    checkout_helper(path, reference, remote_sha, journal)
+    if journal:
+        journal('checked-out', head_sha_helper(path))
+
+def is_sha_helper(reference):
+    """
+    Tests if a reference looks like a full or abbreviated SHA.
+    """
+    return bool(re.match(r'^[0-9a-f]{4,40}$', reference))
+
+def local_sha_helper(git, reference):
     """
-    clone_helper(remote_url, path)
-    checkout_helper(path, reference)
+    Returns the commit SHA the reference resolves to in the local
+    repo of the git command wrapper, or None if it does not resolve.
+    """
+    sha = git.execute(['git', 'rev-parse', '--verify', '-q', reference + '^{commit}'], with_exceptions=False)
+    return sha or None
+
+def is_ancestor_helper(path, ancestor, descendant):
+    """
+    Tests if the commit ancestor is descendant or one of its
+    ancestors in the repo at path. False if either commit is not
+    in the repo.
+    """
+    return Git(path).execute(['git', 'merge-base', '--is-ancestor', ancestor, descendant], with_exceptions=False, with_extended_output=True)[0] == 0
 
+def head_sha_helper(path):
+    """
+    Returns the SHA currently checked out at the given path.
+    """
+    return Git(path).execute(['git', 'rev-parse', 'HEAD'])
+
+def ls_remote_helper(remote_url):
+    """
+    Lists the refs of a remote without cloning or fetching it.
+    Returns a dict mapping ref names to SHAs.
+    """
+    output = Git().execute(['git', 'ls-remote', remote_url])
+    refs = {}
+    for line in output.splitlines():
+        sha, ref = line.split('\t', 1)
+        refs[ref] = sha
+    return refs
+
+def ls_remote_all_helper(remote_urls, processes=None, host_slot=None):
+    """
+    Runs ls_remote_helper once per unique remote URL, concurrently.
+    Returns a dict mapping each remote URL to its refs, or to None
+    if the remote could not be listed. If host_slot is given, each
+    remote is listed inside the context it returns for the URL.
+    """
+    def ls_remote_or_none(remote_url):
+        try:
+            if host_slot:
+                with host_slot(remote_url):
+                    return ls_remote_helper(remote_url)
+            return ls_remote_helper(remote_url)
+        except GitCommandError:
+            return None
+
+    remote_urls = sorted(set(remote_urls))
+    if not remote_urls:
+        return {}
+    pool = ThreadPool(processes)
+    try:
+        results = pool.map(ls_remote_or_none, remote_urls)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(remote_urls, results))
+
+def read_remote_cache_helper(cache_filepath):
+    """
+    Reads the remote refs cache. Returns a dict mapping remote URLs
+    to the time they were listed and their refs.
+    """
+    if not os.path.isfile(cache_filepath):
+        return {}
+    with open(cache_filepath, 'r') as cache_file:
+        return yaml.safe_load(cache_file) or {}
+
+def write_remote_cache_helper(cache_filepath, cache):
+    """
+    Atomically replaces the remote refs cache.
+    """
+    temp_filepath = cache_filepath + '.' + uuid.uuid4().hex
+    with open(temp_filepath, 'w') as cache_file:
+        yaml.safe_dump(cache, cache_file, default_flow_style=False)
+    if os.name == 'nt' and os.path.exists(cache_filepath):
+        os.remove(cache_filepath)
+    os.rename(temp_filepath, cache_filepath)
+
+def cached_refs_helper(cache_filepath, remote_url, ttl):
+    """
+    Returns the cached refs of a remote if they were listed less
+    than ttl seconds ago, otherwise None. Never touches the network.
+    """
+    entry = read_remote_cache_helper(cache_filepath).get(remote_url)
+    if entry and time.time() - entry['time'] < ttl:
+        return entry['refs']
+    return None
+
+def cached_ls_remote_all_helper(remote_urls, cache_filepath, ttl, processes=None, host_slot=None):
+    """
+    Like ls_remote_all_helper, but remotes listed less than ttl
+    seconds ago are answered from the cache file. The remaining
+    remotes are listed concurrently and written back to the cache.
+    """
+    remote_urls = set(remote_urls)
+    cache = read_remote_cache_helper(cache_filepath)
+    now = time.time()
+    stale = [remote_url for remote_url in remote_urls if remote_url not in cache or now - cache[remote_url]['time'] >= ttl]
+    listed = ls_remote_all_helper(stale, processes, host_slot)
+    for remote_url, refs in listed.items():
+        if refs is not None:
+            cache[remote_url] = {'time': now, 'refs': refs}
+    if stale:
+        write_remote_cache_helper(cache_filepath, cache)
+    return dict((remote_url, listed[remote_url] if remote_url in listed else cache[remote_url]['refs']) for remote_url in remote_urls)
+
+def resolve_reference_helper(refs, reference):
+    """
+    Resolves a module reference (remote branch, tag, branch or
+    full SHA) against the refs listed by ls_remote_helper. Returns
+    the SHA, or None if the reference cannot be resolved from the
+    remote alone, e.g. a local branch or an abbreviated SHA.
+    """
+    if re.match(r'^[0-9a-f]{40}$', reference):
+        return reference
+    if reference.startswith('refs/'):
+        candidates = [reference]
+    elif reference.startswith('remotes/origin/'):
+        candidates = ['refs/heads/' + reference[len('remotes/origin/'):]]
+    elif reference.startswith('origin/'):
+        candidates = ['refs/heads/' + reference[len('origin/'):]]
+    else:
+        candidates = ['refs/tags/' + reference, 'refs/heads/' + reference]
+    for candidate in candidates:
+        # Prefer the peeled commit of annotated tags
+        for ref in [candidate + '^{}', candidate]:
+            if ref in refs:
+                return refs[ref]
+    return None
+
+def read_gitmodules_helper(repo_path):
+    """
+    Reads the submodule names, paths and urls straight from the
+    .gitmodules file of the repo at repo_path, without creating
+    submodule objects. Returns a list of dicts in file order.
+    """
+    try:
+        output = Git(repo_path).execute(['git', 'config', '-f', '.gitmodules', '--get-regexp', r'^submodule\..*\.(path|url)$'])
+    except GitCommandError:
+        # git config exits with an error when nothing matches
+        return []
+    submodules = OrderedDict()
+    for line in output.splitlines():
+        key, value = line.split(' ', 1)
+        name, attribute = key[len('submodule.'):].rsplit('.', 1)
+        submodules.setdefault(name, {'name': name})[attribute] = value
+    return [submodule for submodule in submodules.values() if 'path' in submodule and 'url' in submodule]
+
+def gitlink_shas_helper(repo_path, paths):
+    """
+    Reads the commit SHAs recorded for the given submodule paths
+    from the index of the repo at repo_path. Returns a dict mapping
+    paths to SHAs.
+    """
+    output = Git(repo_path).execute(['git', 'ls-files', '--stage', '--'] + list(paths))
+    shas = {}
+    for line in output.splitlines():
+        info, path = line.split('\t', 1)
+        mode, sha = info.split()[:2]
+        if mode == '160000':
+            shas[path] = sha
+    return shas
+
+def remove_config_sections_helper(config_path, sections):
+    """
+    Removes the given sections from a git config file in a single
+    write. Sections that do not exist are ignored.
+    """
+    config = GitConfigParser(config_path, read_only=False)
+    try:
+        for section in sections:
+            if config.has_section(section):
+                config.remove_section(section)
+    finally:
+        config.release()
+
+def detach_submodule_gitdir_helper(path):
+    """
+    If the submodule checkout at path uses a .git file pointing into
+    the superproject, move the git directory into the checkout so the
+    module is a standalone repo, like the ones mpm clones.
+    """
+    gitfile = os.path.join(path, '.git')
+    if not os.path.isfile(gitfile):
+        return
+    with open(gitfile, 'r') as handle:
+        gitdir = handle.read().strip()[len('gitdir:'):].strip()
+    if not os.path.isabs(gitdir):
+        gitdir = os.path.join(path, gitdir)
+    os.remove(gitfile)
+    os.rename(gitdir, gitfile)
+    Git().execute(['git', 'config', '-f', os.path.join(gitfile, 'config'), '--unset', 'core.worktree'], with_exceptions=False)
+
+def read_node_events_helper(events):
+    """
+    Reads the events of the next YAML node (a scalar, alias, or a
+    whole mapping or sequence) from the events iterator and returns
+    them as a list.
+    """
+    node_events = [next(events)]
+    depth = 0
+    if isinstance(node_events[0], yaml.CollectionStartEvent):
+        depth = 1
+    while depth:
+        event = next(events)
+        node_events.append(event)
+        if isinstance(event, yaml.CollectionStartEvent):
+            depth += 1
+        elif isinstance(event, yaml.CollectionEndEvent):
+            depth -= 1
+    return node_events
+
+def stream_manifest_helper(filename, product):
+    """
+    Generator over the module entries of one product in a manifest
+    file. The file is read as a stream of YAML events: the other
+    products are skipped without being constructed and each entry is
+    yielded as soon as it is parsed, so only one entry is held in
+    memory at a time. Yields nothing if the product does not exist.
+    """
+    for _, entry in stream_manifest_products_helper(filename, [product]):
+        yield entry
+
+def stream_manifest_products_helper(filename, products=None):
+    """
+    Generator over the (product, entry) pairs of the products in a
+    manifest file, or of every product if products is None, read in
+    a single pass like stream_manifest_helper. Reading stops once
+    every listed product has been read.
+    """
+    remaining = set(products) if products is not None else None
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    with open(filename, 'r') as handle:
+        events = yaml.parse(handle, Loader=loader)
+        for event in events:
+            if isinstance(event, yaml.MappingStartEvent):
+                break
+            if isinstance(event, yaml.CollectionStartEvent) or isinstance(event, yaml.ScalarEvent):
+                # Not a product mapping, nothing to load
+                return
+        else:
+            return
+
+        while True:
+            key_events = read_node_events_helper(events)
+            if isinstance(key_events[0], yaml.MappingEndEvent):
+                return
+            product = key_events[0].value if isinstance(key_events[0], yaml.ScalarEvent) else None
+            if product is None or (remaining is not None and product not in remaining):
+                read_node_events_helper(events)
+                continue
+            event = next(events)
+            if isinstance(event, yaml.MappingStartEvent):
+                while True:
+                    if isinstance(read_node_events_helper(events)[0], yaml.MappingEndEvent):
+                        break
+                    entry_events = read_node_events_helper(events)
+                    document = [yaml.StreamStartEvent(), yaml.DocumentStartEvent()] + entry_events + [yaml.DocumentEndEvent(), yaml.StreamEndEvent()]
+                    yield product, yaml.load(yaml.emit(document), Loader=loader)
+            elif isinstance(event, yaml.CollectionStartEvent):
+                # A product holding no entries
+                read_node_events_helper(itertools.chain([event], events))
+            if remaining is not None:
+                remaining.discard(product)
+                if not remaining:
+                    return
+
+def git_dir_helper(path):
+    """
+    Returns the absolute path of the git directory of the repo at
+    path, which is not <path>/.git when .git is a gitdir file.
+    """
+    return Git(path).execute(['git', 'rev-parse', '--absolute-git-dir'])
+
+def repo_size_helper(path):
+    """
+    Returns the size in bytes of the git directory of the repo
+    at path.
+    """
+    total = 0
+    for root, dirs, files in os.walk(git_dir_helper(path)):
+        for filename in files:
+            try:
+                total += os.lstat(os.path.join(root, filename)).st_size
+            except OSError:
+                pass
+    return total
+
+def history_walk_time_helper(path):
+    """
+    Times a walk of the full history of the repo at path, the kind
+    of walk `git branch --contains` does. Returns seconds.
+    """
+    start = time.time()
+    Git(path).execute(['git', 'rev-list', '--count', '--all'])
+    return time.time() - start
+
+def maintain_repo_helper(path, threads=1):
+    """
+    Runs repository maintenance on the repo at path. Loose objects
+    and packfiles are repacked into a single pack, then a commit-graph
+    and a multi-pack-index are written. Repacking uses at most the
+    given number of threads. Returns a dict with the bytes reclaimed,
+    the time maintenance took and the history walk time before and
+    after.
+    """
+    git = Git(path)
+    size_before = repo_size_helper(path)
+    walk_before = history_walk_time_helper(path)
+    start = time.time()
+    git.execute(['git', '-c', 'pack.threads=' + str(threads), 'repack', '-a', '-d', '-q'])
+    git.execute(['git', 'commit-graph', 'write', '--reachable'])
+    git.execute(['git', 'multi-pack-index', 'write'])
+    git.execute(['git', 'config', 'mpm.fetchCount', '0'])
+    duration = time.time() - start
+    return {'reclaimed': size_before - repo_size_helper(path), 'duration': duration,
+            'walk_before': walk_before, 'walk_after': history_walk_time_helper(path)}
+
+def repo_stats_helper(path, fetch=True):
+    """
+    Gathers the performance relevant statistics of the repo at path:
+    the git directory size, packfile and loose object counts, whether
+    a commit-graph exists, the ref, remote and tracked file counts,
+    whether sparse checkout and the untracked cache are used, and
+    the seconds a status and, if fetch is set, a no-op fetch take.
+    """
+    git = Git(path)
+    objects = dict(line.split(': ', 1) for line in git.execute(['git', 'count-objects', '-v']).splitlines())
+    info_path = os.path.join(git_dir_helper(path), 'objects', 'info')
+    stats = {
+        'size': repo_size_helper(path),
+        'packs': int(objects['packs']),
+        'loose': int(objects['count']),
+        'commit_graph': os.path.isfile(os.path.join(info_path, 'commit-graph')) or os.path.isdir(os.path.join(info_path, 'commit-graphs')),
+        'refs': len(git.execute(['git', 'for-each-ref', '--format=%(refname)']).splitlines()),
+        'remotes': len(git.execute(['git', 'remote']).splitlines()),
+        'files': len(git.execute(['git', 'ls-files']).splitlines()),
+        'sparse': git.execute(['git', 'config', '--bool', 'core.sparseCheckout'], with_exceptions=False) == 'true',
+        'untracked_cache': git.execute(['git', 'config', '--bool', 'core.untrackedCache'], with_exceptions=False) == 'true',
+    }
+    start = time.time()
+    git.execute(['git', 'status', '--porcelain'])
+    stats['status_time'] = time.time() - start
+    stats['fetch_time'] = None
+    if fetch:
+        start = time.time()
+        git.execute(['git', 'fetch', '--all', '--dry-run', '--quiet'])
+        stats['fetch_time'] = time.time() - start
+    return stats
+
+# Thresholds above which mpm doctor suggests a remedy
+DOCTOR_MAX_PACKS = 20
+DOCTOR_MAX_LOOSE = 1000
+DOCTOR_MAX_FILES = 20000
+DOCTOR_MAX_SIZE = 1024 ** 3
+DOCTOR_MIN_GRAPH_SIZE = 50 * 1024 ** 2
+DOCTOR_MAX_FETCH_TIME = 2.0
+DOCTOR_MAX_STATUS_TIME = 1.0
+
+def perf_remedies_helper(name, stats):
+    """
+    Returns the mpm commands and settings that would speed up the
+    module called name, given its repo_stats_helper statistics.
+    """
+    remedies = []
+    if stats['packs'] > DOCTOR_MAX_PACKS or stats['loose'] > DOCTOR_MAX_LOOSE or (not stats['commit_graph'] and stats['size'] > DOCTOR_MIN_GRAPH_SIZE):
+        remedies.append('repack it and write a commit-graph with: mpm maintain -f ' + name)
+    if stats['remotes'] > 1:
+        remedies.append('remove its {} extra remotes, every update fetches them all'.format(stats['remotes'] - 1))
+    if stats['files'] > DOCTOR_MAX_FILES and not stats['sparse']:
+        remedies.append('check out only the directories you need with: mpm update ' + name + ' -s DIRECTORY')
+    if stats['status_time'] > DOCTOR_MAX_STATUS_TIME and not stats['untracked_cache']:
+        remedies.append('enable the untracked cache with checkout: {untracked_cache: true} in its manifest entry')
+    if stats['fetch_time'] is not None and stats['fetch_time'] > DOCTOR_MAX_FETCH_TIME:
+        remedies.append('fetch it ahead of updates with: mpm prefetch')
+    if stats['size'] > DOCTOR_MAX_SIZE:
+        remedies.append('share it between workspaces through a module store with: export MPM_STORE=~/.mpm-store')
+    return remedies
+
+def record_fetch_helper(path):
+    """
+    Counts a fetch in the repo's mpm.fetchCount config. If the git
+    config mpm.autoMaintain (usually set globally) is a number of
+    fetches and the count reaches it, maintenance is run on the repo.
+    """
+    git = Git(path)
+    threshold = git.execute(['git', 'config', '--int', 'mpm.autoMaintain'], with_exceptions=False)
+    if not threshold or int(threshold) <= 0:
+        return
+    count = int(git.execute(['git', 'config', '--int', 'mpm.fetchCount'], with_exceptions=False) or 0) + 1
+    if count >= int(threshold):
+        click.echo('Running maintenance on ' + path + '...')
+        maintain_repo_helper(path)
+    else:
+        git.execute(['git', 'config', 'mpm.fetchCount', str(count)])
+
+# Hidden refs namespaces mpm prefetch fetches branches and tags into,
+# the former shared with the prefetch task of git maintenance
+PREFETCH_BRANCHES = 'refs/prefetch/remotes/origin/'
+PREFETCH_TAGS = 'refs/prefetch/tags/'
+
+def prefetch_repo_helper(path):
+    """
+    Fetches the branches and tags of the origin remote of the repo
+    at path into hidden refs, without touching the working tree,
+    HEAD, the remote tracking branches or the tags. The time is
+    recorded in the repo's mpm.lastPrefetch config. Returns the
+    prefetched refs, in the format of ls_remote_helper.
+    """
+    git = Git(path)
+    git.execute(['git', 'fetch', '--quiet', '--prune', '--no-tags', '--refmap=', 'origin',
+                 '+refs/heads/*:' + PREFETCH_BRANCHES + '*', '+refs/tags/*:' + PREFETCH_TAGS + '*'])
+    record_fetch_helper(path)
+    if git.execute(['git', 'config', 'log.excludeDecoration'], with_exceptions=False) != 'refs/prefetch/':
+        git.execute(['git', 'config', 'log.excludeDecoration', 'refs/prefetch/'])
+    git.execute(['git', 'config', 'mpm.lastPrefetch', str(int(time.time()))])
+    return prefetched_refs_helper(path)
+
+def prefetched_refs_helper(path):
+    """
+    Returns the refs last prefetched into the repo at path, named
+    as on the remote, in the format of ls_remote_helper. Annotated
+    tags are listed peeled too.
+    """
+    output = Git(path).execute(['git', 'for-each-ref', '--format=%(objectname) %(refname) %(*objectname)', 'refs/prefetch/'])
+    refs = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if fields[1].startswith(PREFETCH_BRANCHES):
+            ref = 'refs/heads/' + fields[1][len(PREFETCH_BRANCHES):]
+        elif fields[1].startswith(PREFETCH_TAGS):
+            ref = 'refs/tags/' + fields[1][len(PREFETCH_TAGS):]
+        else:
+            continue
+        refs[ref] = fields[0]
+        if len(fields) > 2:
+            refs[ref + '^{}'] = fields[2]
+    return refs
+
+def prefetch_time_helper(path):
+    """
+    Returns the time the repo at path was last prefetched, or None.
+    """
+    value = Git(path).execute(['git', 'config', '--int', 'mpm.lastPrefetch'], with_exceptions=False)
+    return int(value) if value else None
+
+def use_prefetched_helper(git, reference, remote_sha):
+    """
+    Points the remote tracking branch or tag named by reference at
+    its prefetched commit, as a fetch would, if that is remote_sha.
+    Returns True if the reference now resolves to remote_sha
+    locally, so the fetch can be skipped.
+    """
+    for prefix in ['refs/remotes/origin/', 'remotes/origin/', 'origin/']:
+        if reference.startswith(prefix):
+            prefetched, target = PREFETCH_BRANCHES + reference[len(prefix):], 'refs/remotes/origin/' + reference[len(prefix):]
+            break
+    else:
+        if is_sha_helper(reference) or (reference.startswith('refs/') and not reference.startswith('refs/tags/')):
+            return False
+        name = reference[len('refs/tags/'):] if reference.startswith('refs/tags/') else reference
+        prefetched, target = PREFETCH_TAGS + name, 'refs/tags/' + name
+    if local_sha_helper(git, prefetched) != remote_sha:
+        return False
+    git.execute(['git', 'update-ref', target, git.execute(['git', 'rev-parse', prefetched])])
+    return True
+
+def format_bytes_helper(size):
+    """
+    Formats a number of bytes for humans, e.g. 1.5 MiB.
+    """
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if abs(size) < 1024 or unit == 'GiB':
+            break
+        size /= 1024.0
+    if unit == 'B':
+        return '{} {}'.format(int(size), unit)
+    return '{:.1f} {}'.format(size, unit)
+
+def resource_usage_helper():
+    """
+    Returns a dict with the resident memory of this process in bytes,
+    its number of open file descriptors and its number of child
+    processes. Values that cannot be read on this platform are None.
+    """
+    usage = {'rss': None, 'fds': None, 'children': None}
+    try:
+        with open('/proc/self/statm') as statm:
+            usage['rss'] = int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        pass
+    for fd_path in ['/proc/self/fd', '/dev/fd']:
+        if os.path.isdir(fd_path):
+            # Less the descriptor used to list the directory
+            usage['fds'] = len(os.listdir(fd_path)) - 1
+            break
+    if os.path.isdir('/proc'):
+        children = 0
+        for pid in os.listdir('/proc'):
+            try:
+                with open(os.path.join('/proc', pid, 'stat')) as stat_file:
+                    # The parent pid follows the parenthesised command name
+                    if int(stat_file.read().rsplit(')', 1)[1].split()[1]) == os.getpid():
+                        children += 1
+            except (IOError, OSError, ValueError, IndexError):
+                pass
+        usage['children'] = children
+    return usage
 
 def yaml_to_path_helper(yaml_path):
     """
@@ -82,9 +734,13 @@ def onerror_helper(func, path, exc_info):
     If the error is due to an access error (read only file)
     it attempts to add write permission and then retries.
     If the error is for another reason it re-raises the error.
+    Paths that no longer exist, e.g. because another process
+    deleting the same tree got there first, are treated as deleted.
     Usage : ``shutil.rmtree(path, onerror=onerror)``
     """
     import stat
+    if not os.path.lexists(path):
+        return
     if not os.access(path, os.W_OK):
         # Is the error an access error ?
         os.chmod(path, stat.S_IWUSR)
@@ -92,16 +748,20 @@ def onerror_helper(func, path, exc_info):
     else:
         raise IOError(exc_info)
 
-def add_to_gitignore_helper(gitignore_filename, entry_string):
+def add_to_gitignore_helper(gitignore_filename, entry_string, directory=True):
     """
     Checks if the entry_string exists in gitignore. If it
-    doesn't, this function will add it.
+    doesn't, this function will add it. If directory is False,
+    the entry also matches a file or a link, such as a module
+    linked from a module store.
     """
-    entry_forward_slash = path_to_yaml_helper(entry_string).strip('/') + '/'
+    entry_forward_slash = path_to_yaml_helper(entry_string).strip('/') + ('/' if directory else '')
     create_gitignore_entry = False
     added = False
     with open(gitignore_filename, 'r+') as gitignore_file:
-        if entry_forward_slash not in gitignore_file.read():
+        if directory and entry_forward_slash not in gitignore_file.read():
+            create_gitignore_entry = True
+        elif not directory and entry_forward_slash not in gitignore_file.read().splitlines():
             create_gitignore_entry = True
     # Add path to .gitignore
     if create_gitignore_entry:
@@ -113,7 +773,8 @@ def add_to_gitignore_helper(gitignore_filename, entry_string):
 def remove_from_gitignore_helper(gitignore_filename, entry_string):
     """
     Checks if the entry_string exists in gitignore. If it
-    doesn't, this function will delete it.
+    doesn't, this function will delete it, whether it was added
+    for a directory or a link.
     """
     entry_forward_slash = path_to_yaml_helper(entry_string).strip('/') + '/'
     lines = None
@@ -123,7 +784,7 @@ def remove_from_gitignore_helper(gitignore_filename, entry_string):
     # Remove item from .gitignore
     with open(gitignore_filename, 'w') as gitignore_file:
         for line in lines:
-            if line != entry_forward_slash + '\n':
+            if line not in [entry_forward_slash + '\n', entry_forward_slash[:-1] + '\n']:
                 gitignore_file.write(line)
             else:
                 removed = True
@@ -137,6 +798,37 @@ def with_open_or_create_tinydb_helper(filepath, storage, table='_default'):
     with TinyDB(filepath, storage=storage, default_table=table):
         pass
 
+def migrate_tinydb_helper(source_filepath, source_storage, target_filepath, target_storage):
+    """
+    Copies every table of the source tinydb file into the target
+    file, converting between storage types.
+    """
+    source = source_storage(source_filepath)
+    target = target_storage(target_filepath)
+    try:
+        data = source.read()
+        if data:
+            target.write(data)
+    finally:
+        source.close()
+        target.close()
+
+def write_product_db_helper(filepath, storage, table, items):
+    """
+    Replaces the tinydb file at filepath with one holding the module
+    entries of a manifest, in the format of the working database.
+    """
+    create_directories_helper(os.path.dirname(filepath))
+    if os.path.exists(filepath):
+        os.remove(filepath)
+    entries = []
+    for item in items:
+        entry = dict((key, item[key]) for key in ['name', 'remote_url', 'reference', 'path'])
+        entry.update((key, item[key]) for key in ['sparse', 'checkout'] if item.get(key))
+        entries.append(entry)
+    with TinyDB(filepath, storage=storage, default_table=table) as product_db:
+        product_db.insert_multiple(entries)
+
 def with_open_or_create_file_helper(filepath, mode):
     """
     Open and or create the file with the input filepath,
@@ -151,3 +843,610 @@ def create_directory_helper(path):
     """
     if not os.path.exists(path):
         os.mkdir(path)
+
+def move_to_trash_helper(path, trash_path):
+    """
+    Atomically renames the path into the trash directory so the
+    caller can carry on while the files are deleted later. If the
+    rename is not possible (e.g. the trash is on another device),
+    the path is deleted in place instead. Returns the trash entry,
+    or None if the path was deleted directly.
+    """
+    create_directory_helper(trash_path)
+    basename = os.path.basename(path.rstrip(os.path.sep))
+    trash_entry = os.path.join(trash_path, basename + '-' + uuid.uuid4().hex)
+    try:
+        os.rename(path, trash_entry)
+    except OSError:
+        shutil.rmtree(path, onerror=onerror_helper)
+        return None
+    return trash_entry
+
+def remove_path_helper(path):
+    """
+    Deletes a file or directory tree, fixing up read only
+    files along the way. Parts deleted concurrently by another
+    process are skipped.
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, onerror=onerror_helper)
+    elif os.path.lexists(path):
+        try:
+            os.remove(path)
+        except OSError:
+            onerror_helper(os.remove, path, sys.exc_info())
+
+def empty_trash_helper(trash_path, processes=None):
+    """
+    Deletes everything in the trash directory. The top level
+    children of every trash entry are deleted concurrently with a
+    thread pool, so one large module is spread across workers too.
+    Returns the number of trash entries deleted. Several processes
+    may empty the trash at once, each skipping what the others have
+    already deleted.
+    """
+    if not os.path.isdir(trash_path):
+        return 0
+    entries = [os.path.join(trash_path, entry) for entry in os.listdir(trash_path)]
+    work = []
+    for entry in entries:
+        if os.path.isdir(entry) and not os.path.islink(entry):
+            try:
+                work.extend(os.path.join(entry, child) for child in os.listdir(entry))
+            except OSError:
+                if os.path.lexists(entry):
+                    raise
+        else:
+            work.append(entry)
+    if work:
+        pool = ThreadPool(processes)
+        try:
+            pool.map(remove_path_helper, work)
+        finally:
+            pool.close()
+            pool.join()
+    for entry in entries:
+        remove_path_helper(entry)
+    return len(entries)
+
+# Windows process creation flags of a reaper without a console
+DETACHED_PROCESS = 0x00000008
+CREATE_NEW_PROCESS_GROUP = 0x00000200
+
+def spawn_trash_reaper_helper(trash_path):
+    """
+    Starts a detached python process that empties the trash
+    directory, so the calling command can return immediately. The
+    reaper runs in its own session, so signals sent to the
+    terminal, such as Ctrl-C or a hangup, don't stop it midway.
+    """
+    command = 'import sys, mpm_helpers; mpm_helpers.empty_trash_helper(sys.argv[1])'
+    if os.name == 'nt':
+        detach = {'creationflags': DETACHED_PROCESS | CREATE_NEW_PROCESS_GROUP}
+    else:
+        detach = {'preexec_fn': os.setsid, 'close_fds': True}
+    with open(os.devnull, 'w') as devnull:
+        subprocess.Popen([sys.executable, '-c', command, os.path.abspath(trash_path)],
+                         stdin=devnull, stdout=devnull, stderr=devnull, **detach)
+
+def reap_trash_helper(trash_path, background=False):
+    """
+    Empties the trash directory, either in this process or in a
+    detached background reaper.
+    """
+    if background:
+        spawn_trash_reaper_helper(trash_path)
+    else:
+        empty_trash_helper(trash_path)
+
+# Lock files held by this process, keyed by path and thread
+HELD_LOCKS = {}
+
+def create_directories_helper(path):
+    """
+    Creates the directory and its parents, tolerating other
+    processes creating them at the same time.
+    """
+    if path and not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+def try_lock_file_helper(lock_file):
+    """
+    Tries to take an exclusive lock on the open lock_file without
+    blocking. Returns False if another process holds it.
+    """
+    try:
+        if fcntl:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        return True
+    except (IOError, OSError):
+        return False
+
+def unlock_file_helper(lock_file):
+    """
+    Releases the lock taken on lock_file by try_lock_file_helper.
+    """
+    if fcntl:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    else:
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+def lock_owner_helper(lock_filepath):
+    """
+    Returns the pid written to the lock file by its holder, or
+    None if it cannot be read.
+    """
+    try:
+        with open(lock_filepath) as lock_file:
+            owner = lock_file.read().strip()
+    except (IOError, OSError):
+        return None
+    return owner if owner.isdigit() else None
+
+@contextmanager
+def file_lock_helper(lock_filepath, timeout=None, description='lock'):
+    """
+    Holds an exclusive lock on lock_filepath, creating it if
+    needed, for the duration of the with block. If another process
+    holds the lock, waits up to timeout seconds for it (forever if
+    None, not at all if 0), saying so if it takes more than a
+    second, and then raises a ClickException. The
+    lock is reentrant within a thread, and the operating system
+    releases it if the holding process dies.
+    """
+    key = (os.path.abspath(lock_filepath), threading.current_thread().ident)
+    if key in HELD_LOCKS:
+        yield
+        return
+
+    create_directories_helper(os.path.dirname(lock_filepath))
+    lock_file = open(lock_filepath, 'a+')
+    try:
+        started = time.time()
+        waiting = False
+        while not try_lock_file_helper(lock_file):
+            owner = lock_owner_helper(lock_filepath)
+            holder = 'Another mpm process' + (' (pid ' + owner + ')' if owner else '')
+            if timeout is not None and time.time() - started >= timeout:
+                raise click.ClickException(holder + ' holds the lock on ' + description + '. Try again once it has finished, or wait for it with --lock-timeout.')
+            if not waiting and time.time() - started >= 1:
+                click.echo(holder + ' holds the lock on ' + description + ', waiting...')
+                waiting = True
+            time.sleep(0.1)
+
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(str(os.getpid()))
+        lock_file.flush()
+        HELD_LOCKS[key] = lock_file
+        try:
+            yield
+        finally:
+            del HELD_LOCKS[key]
+            lock_file.seek(0)
+            lock_file.truncate()
+            lock_file.flush()
+            unlock_file_helper(lock_file)
+    finally:
+        lock_file.close()
+
+def module_filename_helper(module_path):
+    """
+    Returns a flat file name identifying the module checked out at
+    module_path, for the lock and journal files of the module.
+    """
+    return path_to_yaml_helper(os.path.normpath(module_path)).strip('/').replace('/', '.')
+
+def module_lock_filepath_helper(lock_path, module_path):
+    """
+    Returns the lock file guarding the module checked out at
+    module_path, inside the lock_path directory.
+    """
+    return os.path.join(lock_path, 'module-' + module_filename_helper(module_path) + '.lock')
+
+def remote_host_helper(remote_url):
+    """
+    Returns the host a git remote URL connects to, or None for local
+    paths and file URLs. Understands URLs with a scheme as well as
+    the scp-like user@host:path syntax.
+    """
+    match = re.match(r'^([a-zA-Z][a-zA-Z0-9+.-]*)://(?:[^@/]*@)?(\[[^\]]+\]|[^:/]*)', remote_url)
+    if match:
+        if match.group(1).lower() == 'file' or not match.group(2):
+            return None
+        return match.group(2).lower()
+    match = re.match(r'^(?:[^@/:]+@)?([^@/:]{2,}):', remote_url)
+    if match:
+        return match.group(1).lower()
+    return None
+
+def remote_uses_ssh_helper(remote_url):
+    """
+    Tests if git connects to a remote URL over SSH, either with an
+    ssh:// URL or the scp-like user@host:path syntax.
+    """
+    match = re.match(r'^([a-zA-Z][a-zA-Z0-9+.-]*)://', remote_url)
+    if match:
+        return match.group(1).lower() in ['ssh', 'git+ssh', 'ssh+git']
+    return remote_host_helper(remote_url) is not None
+
+@contextmanager
+def host_slot_helper(lock_path, remote_url, limit=None):
+    """
+    Holds one of limit slots for the host of remote_url for the
+    duration of the with block. The slots are lock files shared by
+    all threads and mpm processes using lock_path, so at most limit
+    network operations run against a host at once; the rest wait
+    for a free slot. Does nothing for local remotes or if limit is
+    not set. Reentrant within a thread.
+    """
+    host = remote_host_helper(remote_url) if limit else None
+    key = ('host', os.path.abspath(lock_path), host, threading.current_thread().ident)
+    if not host or key in HELD_LOCKS:
+        yield
+        return
+
+    create_directories_helper(lock_path)
+    prefix = os.path.join(lock_path, 'host-' + re.sub(r'[^a-z0-9.-]', '_', host))
+    lock_file = None
+    while not lock_file:
+        for slot in range(limit):
+            candidate = open('{}-{}.lock'.format(prefix, slot), 'a+')
+            if try_lock_file_helper(candidate):
+                lock_file = candidate
+                break
+            candidate.close()
+        else:
+            time.sleep(0.1)
+
+    HELD_LOCKS[key] = lock_file
+    try:
+        yield
+    finally:
+        del HELD_LOCKS[key]
+        unlock_file_helper(lock_file)
+        lock_file.close()
+
+def start_ssh_multiplexing_helper(ssh='ssh', persist=60):
+    """
+    Makes the git processes started from now on share one
+    multiplexed SSH connection per host (OpenSSH ControlMaster),
+    instead of a new handshake for every clone, fetch and ls-remote.
+    Returns a function that closes the connections and restores the
+    environment, or None if the user configured their own ssh command
+    or the platform does not support multiplexing. Connections left
+    open by a killed process close persist seconds after their last
+    use. If git terminal prompts are disabled, ssh does not prompt
+    either.
+    """
+    if os.name == 'nt' or 'GIT_SSH' in os.environ or 'GIT_SSH_COMMAND' in os.environ:
+        return None
+    if Git().execute(['git', 'config', '--get', 'core.sshCommand'], with_exceptions=False):
+        return None
+
+    control_path = tempfile.mkdtemp(prefix='mpm-ssh-')
+    options = ['-o', 'BatchMode=yes'] if os.environ.get('GIT_TERMINAL_PROMPT') == '0' else []
+    os.environ['GIT_SSH_COMMAND'] = ' '.join(quote(arg) for arg in [
+        ssh, '-o', 'ControlMaster=auto', '-o', 'ControlPath=' + os.path.join(control_path, '%C'), '-o', 'ControlPersist=' + str(persist)] + options)
+
+    def stop():
+        os.environ.pop('GIT_SSH_COMMAND', None)
+        with open(os.devnull, 'w') as devnull:
+            for name in os.listdir(control_path):
+                subprocess.call([ssh, '-o', 'ControlPath=' + os.path.join(control_path, name), '-O', 'exit', 'mpm'],
+                                stdin=devnull, stdout=devnull, stderr=devnull)
+        shutil.rmtree(control_path, ignore_errors=True)
+    return stop
+
+def journal_filepath_helper(journal_path, module_path):
+    """
+    Returns the journal file of the module checked out at
+    module_path, inside the journal_path directory.
+    """
+    return os.path.join(journal_path, module_filename_helper(module_path) + '.yml')
+
+def read_journal_helper(journal_path, module_path):
+    """
+    Returns the last step journaled for the module at module_path,
+    or None if no operation on the module is unfinished.
+    """
+    journal_filepath = journal_filepath_helper(journal_path, module_path)
+    if not os.path.isfile(journal_filepath):
+        return None
+    with open(journal_filepath, 'r') as journal_file:
+        return yaml.safe_load(journal_file) or None
+
+def write_journal_helper(journal_path, module_path, record):
+    """
+    Durably replaces the journaled step of the module at
+    module_path. The record is synced to disk and renamed into
+    place, so a crash leaves either the old or the new step.
+    """
+    create_directories_helper(journal_path)
+    journal_filepath = journal_filepath_helper(journal_path, module_path)
+    temp_filepath = journal_filepath + '.' + uuid.uuid4().hex
+    with open(temp_filepath, 'w') as journal_file:
+        yaml.safe_dump(record, journal_file, default_flow_style=False)
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+    if os.name == 'nt' and os.path.exists(journal_filepath):
+        os.remove(journal_filepath)
+    os.rename(temp_filepath, journal_filepath)
+
+def clear_journal_helper(journal_path, module_path):
+    """
+    Marks the operation on the module at module_path as finished by
+    removing its journal.
+    """
+    journal_filepath = journal_filepath_helper(journal_path, module_path)
+    if os.path.exists(journal_filepath):
+        os.remove(journal_filepath)
+
+def recover_module_helper(journal_path, trash_path, module_path, remote_url):
+    """
+    Recovers the module at module_path from an operation that did
+    not finish. A clone that was started but never finished, or one
+    journaled for another remote, is moved to the trash so it is
+    never mistaken for an installed module, the trash is emptied,
+    and its journal is cleared. Returns the journaled step if the
+    operation can be resumed, otherwise None.
+    """
+    record = read_journal_helper(journal_path, module_path)
+    if not record:
+        return None
+    if record['step'] == 'clone-started' or record['remote_url'] != remote_url:
+        if os.path.exists(module_path):
+            click.echo('Removing the partial clone in ' + path_to_yaml_helper(module_path) + '...')
+            move_to_trash_helper(module_path, trash_path)
+            reap_trash_helper(trash_path)
+        clear_journal_helper(journal_path, module_path)
+        return None
+    return record
+
+# Marks the root directory of a module store
+STORE_MARKER = '.mpm-store'
+
+# Prefix of the clones being staged into a store entry
+STORE_STAGING_PREFIX = '.staging-'
+
+# Seconds after which a staging clone is assumed abandoned
+STORE_STAGING_TTL = 24 * 60 * 60
+
+def store_remote_path_helper(store_path, remote_url):
+    """
+    Returns the directory holding the store entries of remote_url,
+    named after the repo and a hash of the full URL.
+    """
+    name = re.sub(r'[^A-Za-z0-9._-]', '_', os.path.basename(remote_url.rstrip('/')).split('.git')[0]) or 'module'
+    return os.path.join(store_path, name + '-' + hashlib.sha1(remote_url.encode('utf-8')).hexdigest()[:12])
+
+def store_entry_name_helper(sha, sparse=None):
+    """
+    Returns the name of the store entry of a commit, checked out
+    with the sparse directories if any.
+    """
+    if not sparse:
+        return sha
+    return sha + '-' + hashlib.sha1('\n'.join(sorted(sparse)).encode('utf-8')).hexdigest()[:8]
+
+def find_store_entry_helper(remote_path, sha, sparse=None):
+    """
+    Returns the store entry in remote_path of the full or
+    abbreviated commit sha checked out with the sparse directories,
+    or None if there is no single such entry.
+    """
+    if not os.path.isdir(remote_path):
+        return None
+    suffix = store_entry_name_helper('', sparse)
+    matches = [name for name in os.listdir(remote_path)
+               if not name.startswith('.') and not name.endswith('.refs') and name.startswith(sha)
+               and name[40:] == suffix and os.path.isdir(os.path.join(remote_path, name))]
+    if len(matches) != 1:
+        return None
+    return os.path.join(remote_path, matches[0])
+
+def store_lock_helper(store_path, entry_path, timeout=None):
+    """
+    Returns the lock guarding the references and the lifetime of
+    a store entry, shared by the mpm processes of all workspaces.
+    """
+    remote_name = os.path.basename(os.path.dirname(entry_path))
+    lock_filepath = os.path.join(store_path, 'locks', remote_name + '-' + os.path.basename(entry_path) + '.lock')
+    return file_lock_helper(lock_filepath, timeout, 'the store entry ' + entry_path)
+
+def linked_store_helper(module_path):
+    """
+    Returns the store the module at module_path is a link into, or
+    None if it is not a link into a module store.
+    """
+    if not os.path.islink(module_path):
+        return None
+    store_path = os.path.dirname(os.path.dirname(os.readlink(module_path)))
+    if not os.path.isfile(os.path.join(store_path, STORE_MARKER)):
+        return None
+    return store_path
+
+def store_reference_filepath_helper(entry_path, module_path):
+    """
+    Returns the file recording that the module at module_path, in
+    any workspace, is a link to the store entry.
+    """
+    module_path = os.path.abspath(module_path)
+    return os.path.join(entry_path + '.refs', hashlib.sha1(module_path.encode('utf-8')).hexdigest()[:16])
+
+def store_references_helper(entry_path):
+    """
+    Returns the number of module paths linked to the store entry.
+    References whose module path was deleted, or no longer links to
+    the entry, are dropped.
+    """
+    refs_path = entry_path + '.refs'
+    if not os.path.isdir(refs_path):
+        return 0
+    count = 0
+    for name in os.listdir(refs_path):
+        ref_filepath = os.path.join(refs_path, name)
+        with open(ref_filepath, 'r') as ref_file:
+            module_path = ref_file.read()
+        if os.path.islink(module_path) and os.readlink(module_path) == entry_path:
+            count += 1
+        else:
+            os.remove(ref_filepath)
+    return count
+
+def make_read_only_helper(path):
+    """
+    Removes the write permission of every file in the working tree
+    at path, so a store entry shared by many workspaces is not
+    changed through one of them by accident.
+    """
+    for root, directories, filenames in os.walk(path):
+        if root == path and '.git' in directories:
+            directories.remove('.git')
+        for filename in filenames:
+            filepath = os.path.join(root, filename)
+            mode = os.lstat(filepath).st_mode
+            if not stat.S_ISLNK(mode):
+                os.chmod(filepath, stat.S_IMODE(mode) & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+def link_store_entry_helper(entry_path, module_path):
+    """
+    Points module_path at the store entry and records the reference.
+    A link to another entry is replaced atomically. Returns the
+    entry module_path linked to before, or None.
+    """
+    ref_filepath = store_reference_filepath_helper(entry_path, module_path)
+    create_directories_helper(os.path.dirname(ref_filepath))
+    with open(ref_filepath, 'w') as ref_file:
+        ref_file.write(os.path.abspath(module_path))
+    previous = os.readlink(module_path) if os.path.islink(module_path) else None
+    if previous == entry_path:
+        return None
+    if os.path.isdir(module_path) and not os.path.islink(module_path):
+        if os.listdir(module_path):
+            raise click.ClickException(module_path + ' already exists and is not a module, move it away to install the module there.')
+        os.rmdir(module_path)
+    create_directories_helper(os.path.dirname(module_path))
+    temp_path = module_path + '.' + uuid.uuid4().hex
+    os.symlink(entry_path, temp_path)
+    os.rename(temp_path, module_path)
+    return previous
+
+def release_store_entry_helper(store_path, entry_path, module_path, trash_path, timeout=None):
+    """
+    Drops the reference of module_path to the store entry, and
+    moves the entry to the trash if no module links to it anymore.
+    Returns True if the entry was collected.
+    """
+    with store_lock_helper(store_path, entry_path, timeout):
+        ref_filepath = store_reference_filepath_helper(entry_path, module_path)
+        if os.path.exists(ref_filepath):
+            os.remove(ref_filepath)
+        if store_references_helper(entry_path) or not os.path.isdir(entry_path):
+            return False
+        move_to_trash_helper(entry_path, trash_path)
+        if os.path.isdir(entry_path + '.refs'):
+            shutil.rmtree(entry_path + '.refs', onerror=onerror_helper)
+        return True
+
+def store_checkout_helper(store_path, trash_path, remote_url, reference, module_path, remote_sha=None, sparse=None, checkout=None, timeout=None):
+    """
+    Links module_path to the read only store entry of the commit the
+    reference points to, checked out with the sparse directories.
+    If the store already holds the entry nothing is cloned, so the
+    module is installed in milliseconds without using more disk.
+    Otherwise the repo is cloned into a staging directory of the
+    store and renamed into place. The entry module_path linked to
+    before is released.
+    """
+    if not hasattr(os, 'symlink'):
+        raise click.ClickException('The module store needs symbolic links, which are not supported on this platform.')
+    create_directories_helper(store_path)
+    with_open_or_create_file_helper(os.path.join(store_path, STORE_MARKER), 'a+')
+    remote_path = store_remote_path_helper(store_path, remote_url)
+    sha = remote_sha or (reference if is_sha_helper(reference) else None)
+    entry_path = find_store_entry_helper(remote_path, sha, sparse) if sha else None
+    staging_path = None
+    try:
+        if not entry_path:
+            create_directories_helper(remote_path)
+            staging_path = os.path.join(remote_path, STORE_STAGING_PREFIX + uuid.uuid4().hex)
+            clone_and_checkout_helper(remote_url, reference, staging_path, remote_sha, sparse, checkout)
+            entry_path = os.path.join(remote_path, store_entry_name_helper(head_sha_helper(staging_path), sparse))
+            make_read_only_helper(staging_path)
+        with store_lock_helper(store_path, entry_path, timeout):
+            if staging_path and not os.path.isdir(entry_path):
+                os.rename(staging_path, entry_path)
+                staging_path = None
+            if not os.path.isdir(entry_path):
+                raise click.ClickException('The store entry ' + entry_path + ' was collected by another mpm process, try again.')
+            previous = link_store_entry_helper(entry_path, module_path)
+    finally:
+        if staging_path and os.path.exists(staging_path):
+            shutil.rmtree(staging_path, onerror=onerror_helper)
+    if previous and os.path.dirname(os.path.dirname(previous)) == store_path:
+        release_store_entry_helper(store_path, previous, module_path, trash_path, timeout)
+
+def unlink_store_module_helper(store_path, module_path, trash_path, timeout=None):
+    """
+    Removes the link of module_path into the store and releases the
+    store entry it pointed at. Returns True if the entry was
+    collected.
+    """
+    entry_path = os.readlink(module_path)
+    os.remove(module_path)
+    return release_store_entry_helper(store_path, entry_path, module_path, trash_path, timeout)
+
+def move_store_module_helper(store_path, module_path, new_path, timeout=None):
+    """
+    Renames the link of module_path into the store to new_path,
+    moving its reference along so the entry is never unreferenced.
+    """
+    entry_path = os.readlink(module_path)
+    with store_lock_helper(store_path, entry_path, timeout):
+        with open(store_reference_filepath_helper(entry_path, new_path), 'w') as ref_file:
+            ref_file.write(os.path.abspath(new_path))
+        os.rename(module_path, new_path)
+        ref_filepath = store_reference_filepath_helper(entry_path, module_path)
+        if os.path.exists(ref_filepath):
+            os.remove(ref_filepath)
+
+def gc_store_helper(store_path, trash_path, timeout=None):
+    """
+    Collects the store entries no module of any workspace links to
+    anymore, e.g. because a workspace was deleted without purging
+    it, as well as abandoned staging clones. Returns the number of
+    entries moved to the trash.
+    """
+    collected = 0
+    if not os.path.isfile(os.path.join(store_path, STORE_MARKER)):
+        return collected
+    for remote_name in sorted(os.listdir(store_path)):
+        remote_path = os.path.join(store_path, remote_name)
+        if remote_name.startswith('.') or remote_name == 'locks' or not os.path.isdir(remote_path):
+            continue
+        for name in sorted(os.listdir(remote_path)):
+            path = os.path.join(remote_path, name)
+            if name.startswith(STORE_STAGING_PREFIX):
+                if time.time() - os.path.getmtime(path) > STORE_STAGING_TTL:
+                    move_to_trash_helper(path, trash_path)
+                    collected += 1
+            elif name.endswith('.refs'):
+                if os.path.isdir(path) and not os.path.isdir(path[:-len('.refs')]):
+                    shutil.rmtree(path, onerror=onerror_helper)
+            else:
+                with store_lock_helper(store_path, path, timeout):
+                    if os.path.isdir(path) and not store_references_helper(path):
+                        move_to_trash_helper(path, trash_path)
+                        if os.path.isdir(path + '.refs'):
+                            shutil.rmtree(path + '.refs', onerror=onerror_helper)
+                        collected += 1
+    return collected
@@ -0,0 +1,63 @@
+import json
+import sqlite3
+from tinydb.storages import Storage
+
+class SQLiteStorage(Storage):
+    """
+    Stores every TinyDB document as a row in a SQLite database.
+    The database runs in WAL mode, and every write is a single
+    transaction that only touches the rows that changed, found by
+    comparing against the stored rows. TinyDB still reads the whole
+    database for every operation, so queries are not faster than
+    with YAML. The name, path and remote_url of each module are
+    copied to indexed columns for tools querying the file directly.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename, timeout=30, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS tables (name TEXT PRIMARY KEY)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS documents ('
+                                'tbl TEXT NOT NULL, doc_id INTEGER NOT NULL, '
+                                'name TEXT, path TEXT, remote_url TEXT, document TEXT NOT NULL, '
+                                'PRIMARY KEY (tbl, doc_id))')
+        for column in ['name', 'path', 'remote_url']:
+            self.connection.execute('CREATE INDEX IF NOT EXISTS documents_{0} ON documents (tbl, {0})'.format(column))
+
+    def read(self):
+        data = {}
+        for (table,) in self.connection.execute('SELECT name FROM tables'):
+            data[table] = {}
+        for table, doc_id, document in self.connection.execute('SELECT tbl, doc_id, document FROM documents'):
+            data.setdefault(table, {})[doc_id] = json.loads(document)
+        if not data:
+            return None
+        return data
+
+    def write(self, data):
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            current = {}
+            for table, doc_id, document in self.connection.execute('SELECT tbl, doc_id, document FROM documents'):
+                current[(table, doc_id)] = document
+            current_tables = set(table for (table,) in self.connection.execute('SELECT name FROM tables'))
+
+            rows = []
+            for table, documents in data.items():
+                for doc_id, document in documents.items():
+                    key = (table, int(doc_id))
+                    serialized = json.dumps(dict(document), sort_keys=True)
+                    if current.pop(key, None) != serialized:
+                        rows.append(key + (document.get('name'), document.get('path'), document.get('remote_url'), serialized))
+
+            self.connection.executemany('DELETE FROM documents WHERE tbl = ? AND doc_id = ?', list(current))
+            self.connection.executemany('INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self.connection.executemany('DELETE FROM tables WHERE name = ?', [(table,) for table in current_tables - set(data)])
+            self.connection.executemany('INSERT INTO tables VALUES (?)', [(table,) for table in set(data) - current_tables])
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+
+    def close(self):
+        self.connection.close()
@@ -1,13 +1,56 @@
 import unittest
+import json
 import os
 import shutil
 import stat
+import threading
+import time
+import click
+from click.testing import CliRunner
 
-from mpm import MPMMetadata, mpm_init, mpm_purge, mpm_install, mpm_uninstall, mpm_update, mpm_load, mpm_freeze, mpm_convert, mpm_show
-from mpm_helpers import clone_and_checkout_helper, clone_helper, checkout_helper, yaml_to_path_helper, path_to_yaml_helper, onerror_helper, remove_from_gitignore_helper, add_to_gitignore_helper, is_local_commit_helper, with_open_or_create_tinydb_helper, with_open_or_create_file_helper, create_directory_helper
+from mpm import MPMMetadata, mpm_init, mpm_purge, mpm_install, mpm_uninstall, mpm_update, mpm_update_all, mpm_outdated, mpm_prefetch, mpm_load, mpm_freeze, mpm_gc, mpm_maintain, mpm_doctor, mpm_convert, mpm_show
+from mpm_helpers import clone_and_checkout_helper, clone_helper, checkout_helper, yaml_to_path_helper, path_to_yaml_helper, onerror_helper, remove_from_gitignore_helper, add_to_gitignore_helper, is_local_commit_helper, with_open_or_create_tinydb_helper, with_open_or_create_file_helper, create_directory_helper, move_to_trash_helper, empty_trash_helper, is_sha_helper, ls_remote_helper, resolve_reference_helper, read_gitmodules_helper, remove_config_sections_helper, write_remote_cache_helper, cached_refs_helper, cached_ls_remote_all_helper, sparse_checkout_helper, stream_manifest_helper, stream_manifest_products_helper, maintain_repo_helper, record_fetch_helper, format_bytes_helper, file_lock_helper, module_lock_filepath_helper, remote_host_helper, host_slot_helper, start_ssh_multiplexing_helper, checkout_config_helper, checkout_settings_helper, write_journal_helper, read_journal_helper, clear_journal_helper, recover_module_helper, store_checkout_helper, store_references_helper, unlink_store_module_helper, linked_store_helper, gc_store_helper, prefetch_repo_helper, prefetch_time_helper, head_sha_helper, is_ancestor_helper, repo_stats_helper, perf_remedies_helper, resource_usage_helper, git_dir_helper, repo_size_helper, create_directories_helper, remote_uses_ssh_helper
 from mpm_yaml_storage import YAMLStorage
+from mpm_sqlite_storage import SQLiteStorage
+from mpm_daemon import serve_daemon, stop_daemon, forward_to_daemon, is_daemon_running
+from mpm_cli import cli
 from tinydb import TinyDB, Query
-from git import Repo, GitCommandError
+from git import Repo, Git, GitCommandError
+
+def hold_lock(lock_filepath, acquired, release):
+    """
+    Holds the lock from another thread until release is set.
+    """
+    with file_lock_helper(lock_filepath):
+        acquired.set()
+        release.wait()
+
+def hold_host_slot(lock_path, remote_url, acquired, release):
+    """
+    Holds a host slot from another thread until release is set.
+    """
+    with host_slot_helper(lock_path, remote_url, 1):
+        acquired.set()
+        release.wait()
+
+def create_repo(path):
+    """
+    Creates a repo at path with a single commit adding file.txt,
+    for tests to use as a module remote. Returns the commit SHA.
+    """
+    repo = Repo.init(path)
+    with_open_or_create_file_helper(os.path.join(path, 'file.txt'), 'a+')
+    repo.git.add('--all')
+    sha = repo.index.commit('Added a file').hexsha
+    repo.close()
+    return sha
+
+# Stand-in for ssh that logs its arguments and runs git locally
+FAKE_SSH = """#!/bin/sh
+echo "$@" >> "$(dirname "$0")/ssh.log"
+for last; do :; done
+case "$last" in git-*) exec sh -c "$last";; esac
+"""
 
 class HelperObject(object):
     pass
@@ -19,7 +62,7 @@ class TestHelpers(unittest.TestCase):
         ref = '2dc33423188a7e06fa6e9725a0a74059b009ff6a'
         clone_helper(url, path)
         repo = Repo(path)
-        self.assertFalse(is_local_commit_helper(repo, '2dc3342318'))
+        self.assertFalse(is_local_commit_helper(repo.git, '2dc3342318'))
         repo.close()
         shutil.rmtree(path, onerror=onerror_helper)
         os.rmdir('test')
@@ -31,13 +74,13 @@ class TestHelpers(unittest.TestCase):
         clone_helper(url, path)
         repo = Repo(path)
         branch = repo.create_head('test_branch', '2dc33423188a7e06fa6e9725a0a74059b009ff6a')
-        self.assertTrue(is_local_commit_helper(repo, 'test_branch'))
+        self.assertTrue(is_local_commit_helper(repo.git, 'test_branch'))
         repo.git.checkout('test_branch')
         new_path = os.path.join(path, 'test_module')
         os.mkdir(new_path)
         repo.index.add(['test_module'])
         repo.index.commit("Added a new folder test")
-        self.assertTrue(is_local_commit_helper(repo, 'test_branch'))
+        self.assertTrue(is_local_commit_helper(repo.git, 'test_branch'))
         repo.close()
         shutil.rmtree(path, onerror=onerror_helper)
         os.rmdir('test')
@@ -105,6 +148,370 @@ class TestHelpers(unittest.TestCase):
         shutil.rmtree(path, onerror=onerror_helper)
         os.rmdir('test')
 
+    def test_ls_remote_helper(self):
+        url = 'https://github.com/msembinelli/broker.git'
+        refs = ls_remote_helper(url)
+        self.assertIn('refs/heads/master', refs)
+        self.assertRaises(GitCommandError, ls_remote_helper, 'https://github.com/fake/repo/repo123456789.git')
+
+    def test_resolve_reference_helper(self):
+        sha = '2dc33423188a7e06fa6e9725a0a74059b009ff6a'
+        refs = {'refs/heads/master': 'a' * 40, 'refs/tags/v1': 'b' * 40, 'refs/tags/v1^{}': 'c' * 40}
+        self.assertEqual('a' * 40, resolve_reference_helper(refs, 'remotes/origin/master'))
+        self.assertEqual('a' * 40, resolve_reference_helper(refs, 'origin/master'))
+        self.assertEqual('a' * 40, resolve_reference_helper(refs, 'master'))
+        self.assertEqual('c' * 40, resolve_reference_helper(refs, 'v1'))
+        self.assertEqual(sha, resolve_reference_helper(refs, sha))
+        self.assertIsNone(resolve_reference_helper(refs, '2dc3342'))
+        self.assertIsNone(resolve_reference_helper(refs, 'local_branch'))
+
+    def test_cached_refs_helper(self):
+        filepath = 'remote-refs.yml'
+        url = 'https://github.com/fake/repo/repo123456789.git'
+        refs = {'refs/heads/master': 'a' * 40}
+        write_remote_cache_helper(filepath, {url: {'time': time.time(), 'refs': refs}})
+        self.assertEqual(refs, cached_refs_helper(filepath, url, 60))
+        self.assertIsNone(cached_refs_helper(filepath, url, 0))
+        self.assertIsNone(cached_refs_helper(filepath, 'https://github.com/msembinelli/broker.git', 60))
+        os.remove(filepath)
+
+    def test_cached_ls_remote_all_helper(self):
+        filepath = 'remote-refs.yml'
+        cached_url = 'https://github.com/fake/repo/cached.git'
+        bad_url = 'https://github.com/fake/repo/repo123456789.git'
+        refs = {'refs/heads/master': 'a' * 40}
+        write_remote_cache_helper(filepath, {cached_url: {'time': time.time(), 'refs': refs}, bad_url: {'time': 0, 'refs': refs}})
+        remote_refs = cached_ls_remote_all_helper([cached_url, bad_url], filepath, 60)
+        self.assertEqual(refs, remote_refs[cached_url])
+        self.assertIsNone(remote_refs[bad_url])
+        os.remove(filepath)
+
+    def test_is_sha_helper(self):
+        self.assertTrue(is_sha_helper('2dc3342'))
+        self.assertTrue(is_sha_helper('2dc33423188a7e06fa6e9725a0a74059b009ff6a'))
+        self.assertFalse(is_sha_helper('remotes/origin/master'))
+
+    def test_read_gitmodules_helper(self):
+        path = 'tmp'
+        create_directory_helper(path)
+        with open(os.path.join(path, '.gitmodules'), 'w') as gitmodules:
+            gitmodules.write('[submodule "libs/broker"]\n\tpath = libs/broker\n\turl = https://github.com/msembinelli/broker.git\n'
+                             '[submodule "q2"]\n\tpath = q2\n\turl = https://github.com/msembinelli/q2.git\n')
+        submodules = read_gitmodules_helper(path)
+        self.assertEqual(['libs/broker', 'q2'], [submodule['name'] for submodule in submodules])
+        self.assertEqual('libs/broker', submodules[0]['path'])
+        self.assertEqual('https://github.com/msembinelli/q2.git', submodules[1]['url'])
+        remove_config_sections_helper(os.path.join(path, '.gitmodules'), ['submodule "q2"', 'submodule "missing"'])
+        self.assertEqual(['libs/broker'], [submodule['name'] for submodule in read_gitmodules_helper(path)])
+        shutil.rmtree(path, onerror=onerror_helper)
+
+    def test_read_gitmodules_helper_no_submodules(self):
+        path = 'tmp'
+        create_directory_helper(path)
+        with_open_or_create_file_helper(os.path.join(path, '.gitmodules'), 'a+')
+        self.assertEqual([], read_gitmodules_helper(path))
+        shutil.rmtree(path, onerror=onerror_helper)
+
+    def test_sparse_checkout_helper(self):
+        path = 'tmp'
+        repo = Repo.init(path)
+        for directory in ['src', 'docs']:
+            os.mkdir(os.path.join(path, directory))
+            with_open_or_create_file_helper(os.path.join(path, directory, 'file.txt'), 'a+')
+        repo.git.add('--all')
+        repo.index.commit('Added test folders')
+        sparse_checkout_helper(path, ['src'])
+        self.assertTrue(os.path.exists(os.path.join(path, 'src')))
+        self.assertFalse(os.path.exists(os.path.join(path, 'docs')))
+        sparse_checkout_helper(path, [])
+        self.assertTrue(os.path.exists(os.path.join(path, 'docs')))
+        repo.close()
+        shutil.rmtree(path, onerror=onerror_helper)
+
+    def test_checkout_config_helper(self):
+        self.assertEqual([('core', 'untrackedCache', 'false'), ('checkout', 'workers', '8')], checkout_config_helper({'workers': 8, 'untracked_cache': False}))
+        self.assertEqual([], checkout_config_helper(None))
+        with self.assertRaises(click.ClickException):
+            checkout_config_helper({'fsmonitor': True})
+        with self.assertRaises(click.ClickException):
+            checkout_config_helper({'workers': 'many'})
+
+    def test_checkout_settings_helper(self):
+        path = 'tmp'
+        repo = Repo.init(path)
+        checkout_settings_helper(path, {'workers': 4})
+        reader = repo.config_reader()
+        self.assertEqual(4, reader.get_value('checkout', 'workers'))
+        self.assertTrue(reader.get_value('core', 'preloadIndex'))
+        self.assertFalse(reader.has_option('core', 'untrackedCache'))
+        repo.close()
+        shutil.rmtree(path, onerror=onerror_helper)
+
+    def test_checkout_settings_helper_gitdir_file(self):
+        path = 'tmp'
+        gitdir = os.path.abspath('tmp-gitdir')
+        Git().execute(['git', 'init', '-q', '--separate-git-dir', gitdir, path])
+        self.assertTrue(os.path.isfile(os.path.join(path, '.git')))
+        checkout_settings_helper(path, {'workers': 4})
+        self.assertEqual('4', Git(path).execute(['git', 'config', 'checkout.workers']))
+        shutil.rmtree(path, onerror=onerror_helper)
+        shutil.rmtree(gitdir, onerror=onerror_helper)
+
+    def test_clone_and_checkout_helper_checkout_settings(self):
+        remote_path = os.path.abspath('remote')
+        create_repo(remote_path)
+        path = 'tmp'
+        clone_and_checkout_helper('file://' + remote_path, 'remotes/origin/master', path, None, None, {'workers': 2})
+        self.assertTrue(os.path.isfile(os.path.join(path, 'file.txt')))
+        repo = Repo(path)
+        self.assertEqual(2, repo.config_reader().get_value('checkout', 'workers'))
+        repo.close()
+        shutil.rmtree(path, onerror=onerror_helper)
+        shutil.rmtree(remote_path, onerror=onerror_helper)
+
+    def test_clone_and_checkout_helper_journal(self):
+        remote_path = os.path.abspath('remote')
+        sha = create_repo(remote_path)
+        path = 'tmp'
+        steps = []
+        journal = lambda step, sha=None: steps.append((step, sha))
+        clone_and_checkout_helper('file://' + remote_path, 'remotes/origin/master', path, journal=journal)
+        self.assertEqual([('clone-started', None), ('cloned', None), ('fetched', sha), ('checked-out', sha)], steps)
+        del steps[:]
+        clone_and_checkout_helper('file://' + remote_path, 'remotes/origin/master', path, journal=journal)
+        self.assertEqual([('fetched', sha), ('checked-out', sha)], steps)
+        shutil.rmtree(path, onerror=onerror_helper)
+        shutil.rmtree(remote_path, onerror=onerror_helper)
+
+    def test_clone_and_checkout_helper_resource_usage(self):
+        remote_path = os.path.abspath('remote')
+        create_repo(remote_path)
+        clone_and_checkout_helper('file://' + remote_path, 'remotes/origin/master', 'tmp0')
+        before = resource_usage_helper()
+        for index in range(1, 6):
+            clone_and_checkout_helper('file://' + remote_path, 'remotes/origin/master', 'tmp' + str(index))
+        after = resource_usage_helper()
+        self.assertEqual(before['fds'], after['fds'])
+        self.assertEqual(before['children'], after['children'])
+        for index in range(6):
+            shutil.rmtree('tmp' + str(index), onerror=onerror_helper)
+        shutil.rmtree(remote_path, onerror=onerror_helper)
+
+    def test_journal_helpers(self):
+        journal_path = 'journal'
+        path = os.path.join('modules', 'a')
+        self.assertIsNone(read_journal_helper(journal_path, path))
+        write_journal_helper(journal_path, path, {'step': 'cloned', 'name': 'a'})
+        self.assertEqual({'step': 'cloned', 'name': 'a'}, read_journal_helper(journal_path, path))
+        write_journal_helper(journal_path, path, {'step': 'fetched', 'name': 'a', 'sha': '2dc3342'})
+        self.assertEqual('fetched', read_journal_helper(journal_path, path)['step'])
+        self.assertEqual(['modules.a.yml'], os.listdir(journal_path))
+        clear_journal_helper(journal_path, path)
+        clear_journal_helper(journal_path, path)
+        self.assertIsNone(read_journal_helper(journal_path, path))
+        shutil.rmtree(journal_path)
+
+    def test_recover_module_helper(self):
+        journal_path = 'journal'
+        trash_path = 'trash'
+        path = 'tmp'
+        remote_url = 'https://github.com/msembinelli/q2.git'
+        self.assertIsNone(recover_module_helper(journal_path, trash_path, path, remote_url))
+        create_directory_helper(path)
+        write_journal_helper(journal_path, path, {'step': 'fetched', 'remote_url': remote_url, 'sha': '2dc3342'})
+        self.assertEqual('fetched', recover_module_helper(journal_path, trash_path, path, remote_url)['step'])
+        self.assertTrue(os.path.isdir(path))
+        self.assertIsNone(recover_module_helper(journal_path, trash_path, path, 'https://github.com/msembinelli/broker.git'))
+        self.assertFalse(os.path.exists(path))
+        create_directory_helper(path)
+        write_journal_helper(journal_path, path, {'step': 'clone-started', 'remote_url': remote_url})
+        self.assertIsNone(recover_module_helper(journal_path, trash_path, path, remote_url))
+        self.assertFalse(os.path.exists(path))
+        self.assertIsNone(read_journal_helper(journal_path, path))
+        self.assertEqual([], os.listdir(trash_path))
+        os.rmdir(trash_path)
+        shutil.rmtree(journal_path, onerror=onerror_helper)
+
+    def test_store_checkout_helper(self):
+        remote_path = os.path.abspath('remote')
+        sha = create_repo(remote_path)
+        store_path = os.path.abspath('store')
+        paths = [os.path.join('tmp', 'a'), os.path.join('tmp', 'b')]
+        for path in paths:
+            store_checkout_helper(store_path, 'trash', 'file://' + remote_path, 'remotes/origin/master', path, sha)
+            self.assertEqual(store_path, linked_store_helper(path))
+        entry_path = os.readlink(paths[0])
+        self.assertEqual(entry_path, os.readlink(paths[1]))
+        self.assertEqual(sha, os.path.basename(entry_path))
+        self.assertEqual(2, store_references_helper(entry_path))
+        self.assertFalse(os.stat(os.path.join(paths[0], 'file.txt')).st_mode & stat.S_IWUSR)
+        self.assertFalse(unlink_store_module_helper(store_path, paths[0], 'trash'))
+        self.assertFalse(os.path.lexists(paths[0]))
+        self.assertTrue(unlink_store_module_helper(store_path, paths[1], 'trash'))
+        self.assertFalse(os.path.exists(entry_path))
+        shutil.rmtree('tmp', onerror=onerror_helper)
+        shutil.rmtree('trash', onerror=onerror_helper)
+        shutil.rmtree(store_path, onerror=onerror_helper)
+        shutil.rmtree(remote_path, onerror=onerror_helper)
+
+    def test_gc_store_helper(self):
+        remote_path = os.path.abspath('remote')
+        create_repo(remote_path)
+        store_path = os.path.abspath('store')
+        self.assertEqual(0, gc_store_helper(store_path, 'trash'))
+        path = 'tmp'
+        store_checkout_helper(store_path, 'trash', 'file://' + remote_path, 'remotes/origin/master', path)
+        self.assertEqual(0, gc_store_helper(store_path, 'trash'))
+        entry_path = os.readlink(path)
+        os.remove(path)
+        self.assertEqual(1, gc_store_helper(store_path, 'trash'))
+        self.assertFalse(os.path.exists(entry_path))
+        self.assertFalse(os.path.exists(entry_path + '.refs'))
+        shutil.rmtree('trash', onerror=onerror_helper)
+        shutil.rmtree(store_path, onerror=onerror_helper)
+        shutil.rmtree(remote_path, onerror=onerror_helper)
+
+    def test_prefetch_repo_helper(self):
+        remote_path = os.path.abspath('remote')
+        old_sha = create_repo(remote_path)
+        repo = Repo(remote_path)
+        path = 'tmp'
+        clone_and_checkout_helper('file://' + remote_path, 'remotes/origin/master', path)
+        self.assertIsNone(prefetch_time_helper(path))
+        new_sha = repo.index.commit('Empty commit').hexsha
+        repo.create_tag('v1')
+        repo.close()
+        refs = prefetch_repo_helper(path)
+        self.assertEqual(new_sha, refs['refs/heads/master'])
+        self.assertEqual(new_sha, refs['refs/tags/v1'])
+        self.assertTrue(prefetch_time_helper(path) <= time.time())
+        self.assertEqual(old_sha, head_sha_helper(path))
+        self.assertEqual(old_sha, Git(path).execute(['git', 'rev-parse', 'remotes/origin/master']))
+        shutil.move(remote_path, remote_path + '.moved')
+        checkout_helper(path, 'remotes/origin/master', new_sha)
+        self.assertEqual(new_sha, head_sha_helper(path))
+        shutil.rmtree(path, onerror=onerror_helper)
+        shutil.rmtree(remote_path + '.moved', onerror=onerror_helper)
+
+    def test_repo_stats_helper(self):
+        remote_path = os.path.abspath('remote')
+        create_repo(remote_path)
+        path = 'tmp'
+        clone_and_checkout_helper('file://' + remote_path, 'remotes/origin/master', path)
+        stats = repo_stats_helper(path)
+        self.assertEqual(1, stats['files'])
+        self.assertEqual(1, stats['remotes'])
+        self.assertFalse(stats['sparse'])
+        self.assertTrue(stats['size'] > 0)
+        self.assertTrue(stats['fetch_time'] >= 0)
+        self.assertIsNone(repo_stats_helper(path, fetch=False)['fetch_time'])
+        shutil.rmtree(path, onerror=onerror_helper)
+        shutil.rmtree(remote_path, onerror=onerror_helper)
+
+    def test_repo_stats_helper_gitdir_file(self):
+        path = 'tmp'
+        gitdir = os.path.abspath('tmp-gitdir')
+        Git().execute(['git', 'init', '-q', '--separate-git-dir', gitdir, path])
+        create_repo(path)
+        Git(path).execute(['git', 'commit-graph', 'write', '--reachable'])
+        stats = repo_stats_helper(path, False)
+        self.assertTrue(stats['size'] > 0)
+        self.assertTrue(stats['commit_graph'])
+        shutil.rmtree(path, onerror=onerror_helper)
+        shutil.rmtree(gitdir, onerror=onerror_helper)
+
+    def test_perf_remedies_helper(self):
+        stats = {'size': 1024, 'packs': 1, 'loose': 0, 'commit_graph': True, 'refs': 10, 'remotes': 1, 'files': 10,
+                 'sparse': False, 'untracked_cache': False, 'status_time': 0.1, 'fetch_time': 0.1}
+        self.assertEqual([], perf_remedies_helper('a', stats))
+        stats.update({'packs': 50, 'remotes': 3, 'files': 100000, 'status_time': 5.0, 'fetch_time': None})
+        remedies = perf_remedies_helper('a', stats)
+        self.assertEqual(4, len(remedies))
+        self.assertTrue('mpm maintain -f a' in remedies[0])
+        self.assertTrue('2 extra remotes' in remedies[1])
+        self.assertTrue('mpm update a -s' in remedies[2])
+        self.assertTrue('untracked_cache' in remedies[3])
+
+    def test_stream_manifest_helper(self):
+        filename = 'package-test.yaml'
+        with open(filename, 'w') as manifest:
+            manifest.write('other:\n  1: {name: q2, path: modules/q2, reference: 2dc3342, remote_url: https://github.com/msembinelli/q2.git}\n'
+                           'test:\n  1:\n    name: broker\n    path: modules/broker\n    reference: remotes/origin/master\n'
+                           '    remote_url: https://github.com/msembinelli/broker.git\n    sparse:\n    - docs\n'
+                           'empty: {}\n')
+        entries = stream_manifest_helper(filename, 'test')
+        self.assertEqual({'name': 'broker', 'path': 'modules/broker', 'reference': 'remotes/origin/master',
+                          'remote_url': 'https://github.com/msembinelli/broker.git', 'sparse': ['docs']}, next(entries))
+        self.assertRaises(StopIteration, next, entries)
+        self.assertEqual(['q2'], [entry['name'] for entry in stream_manifest_helper(filename, 'other')])
+        self.assertEqual([], list(stream_manifest_helper(filename, 'empty')))
+        self.assertEqual([], list(stream_manifest_helper(filename, 'missing')))
+        os.remove(filename)
+
+    def test_stream_manifest_products_helper(self):
+        filename = 'package-test.yaml'
+        with open(filename, 'w') as manifest:
+            manifest.write('a:\n  1: {name: q2, path: modules/q2}\n  2: {name: broker, path: modules/broker}\n'
+                           'b: []\nc:\n  1: {name: q2, path: modules/q2}\nd:\n')
+        self.assertEqual([('a', 'q2'), ('a', 'broker'), ('c', 'q2')],
+                         [(product, entry['name']) for product, entry in stream_manifest_products_helper(filename, ['a', 'b', 'c'])])
+        self.assertEqual([('c', 'q2')], [(product, entry['name']) for product, entry in stream_manifest_products_helper(filename, ['c', 'missing'])])
+        self.assertEqual(3, len(list(stream_manifest_products_helper(filename))))
+        os.remove(filename)
+
+    def test_stream_manifest_helper_empty_file(self):
+        filename = 'package-test.yaml'
+        with_open_or_create_file_helper(filename, 'a+')
+        self.assertEqual([], list(stream_manifest_helper(filename, '_default')))
+        os.remove(filename)
+
+    def test_maintain_repo_helper(self):
+        path = 'tmp'
+        create_repo(path)
+        result = maintain_repo_helper(path)
+        self.assertTrue(os.path.isfile(os.path.join(path, '.git', 'objects', 'info', 'commit-graph')))
+        self.assertTrue(os.path.isfile(os.path.join(path, '.git', 'objects', 'pack', 'multi-pack-index')))
+        self.assertEqual(set(['reclaimed', 'duration', 'walk_before', 'walk_after']), set(result))
+        shutil.rmtree(path, onerror=onerror_helper)
+
+    def test_maintain_repo_helper_gitdir_file(self):
+        path = 'tmp'
+        gitdir = os.path.abspath('tmp-gitdir')
+        Git().execute(['git', 'init', '-q', '--separate-git-dir', gitdir, path])
+        self.assertEqual(gitdir, git_dir_helper(path))
+        create_repo(path)
+        self.assertTrue(repo_size_helper(path) > 0)
+        self.assertNotEqual(0, maintain_repo_helper(path)['reclaimed'])
+        self.assertTrue(os.path.isfile(os.path.join(gitdir, 'objects', 'info', 'commit-graph')))
+        shutil.rmtree(path, onerror=onerror_helper)
+        shutil.rmtree(gitdir, onerror=onerror_helper)
+
+    def test_record_fetch_helper(self):
+        path = 'tmp'
+        create_repo(path)
+        repo = Repo(path)
+        repo.git.config('mpm.autoMaintain', '2')
+        record_fetch_helper(path)
+        self.assertEqual('1', repo.git.config('mpm.fetchCount'))
+        record_fetch_helper(path)
+        self.assertEqual('0', repo.git.config('mpm.fetchCount'))
+        self.assertTrue(os.path.isfile(os.path.join(path, '.git', 'objects', 'info', 'commit-graph')))
+        repo.close()
+        shutil.rmtree(path, onerror=onerror_helper)
+
+    def test_format_bytes_helper(self):
+        self.assertEqual('512 B', format_bytes_helper(512))
+        self.assertEqual('1.5 KiB', format_bytes_helper(1536))
+        self.assertEqual('-2.0 MiB', format_bytes_helper(-2 * 1024 * 1024))
+
+    def test_resource_usage_helper(self):
+        usage = resource_usage_helper()
+        self.assertEqual(set(['rss', 'fds', 'children']), set(usage))
+        if os.path.isdir('/proc'):
+            self.assertTrue(usage['rss'] > 0)
+            with open(__file__):
+                self.assertEqual(usage['fds'] + 1, resource_usage_helper()['fds'])
+
     def test_yaml_to_path_helper(self):
         yaml_path = '/test/folder'
         expected_path = os.path.sep + 'test' + os.path.sep + 'folder'
@@ -190,6 +597,134 @@ class TestHelpers(unittest.TestCase):
         self.assertRaises(IOError, onerror_helper, os.remove, filepath, 'test exception message')
         shutil.rmtree(path, onerror=onerror_helper)
 
+    def test_move_to_trash_helper(self):
+        path = 'tmp'
+        trash_path = 'trash'
+        create_directory_helper(path)
+        with_open_or_create_file_helper(os.path.join(path, 'file.txt'), 'a+')
+        trash_entry = move_to_trash_helper(path, trash_path)
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.isfile(os.path.join(trash_entry, 'file.txt')))
+        self.assertEqual(os.path.dirname(trash_entry), trash_path)
+        shutil.rmtree(trash_path, onerror=onerror_helper)
+
+    def test_empty_trash_helper(self):
+        trash_path = 'trash'
+        for name in ['a', 'b']:
+            path = os.path.join('tmp', name)
+            create_directory_helper('tmp')
+            create_directory_helper(path)
+            filepath = os.path.join(path, 'file.txt')
+            with_open_or_create_file_helper(filepath, 'a+')
+            os.chmod(filepath, stat.S_IREAD)
+            move_to_trash_helper(path, trash_path)
+        os.rmdir('tmp')
+        self.assertEqual(2, empty_trash_helper(trash_path))
+        self.assertEqual([], os.listdir(trash_path))
+        os.rmdir(trash_path)
+
+    def test_empty_trash_helper_concurrently(self):
+        trash_path = 'trash'
+        for name in ['a', 'b']:
+            path = os.path.join('tmp', name)
+            for index in range(200):
+                create_directories_helper(os.path.join(path, str(index % 20)))
+                with_open_or_create_file_helper(os.path.join(path, str(index % 20), str(index)), 'a+')
+            move_to_trash_helper(path, trash_path)
+        os.rmdir('tmp')
+        errors = []
+        def empty():
+            try:
+                empty_trash_helper(trash_path, 4)
+            except Exception as error:
+                errors.append(error)
+        threads = [threading.Thread(target=empty) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual([], os.listdir(trash_path))
+        os.rmdir(trash_path)
+
+    def test_empty_trash_helper_no_trash(self):
+        self.assertEqual(0, empty_trash_helper('trash'))
+
+    def test_file_lock_helper(self):
+        lock_filepath = os.path.join('locks', 'test.lock')
+        acquired, release = threading.Event(), threading.Event()
+        thread = threading.Thread(target=hold_lock, args=(lock_filepath, acquired, release))
+        thread.start()
+        acquired.wait()
+        with open(lock_filepath) as lock_file:
+            self.assertEqual(str(os.getpid()), lock_file.read())
+        with self.assertRaises(click.ClickException):
+            with file_lock_helper(lock_filepath, 0, 'the test'):
+                pass
+        release.set()
+        thread.join()
+        with file_lock_helper(lock_filepath, 0):
+            with file_lock_helper(lock_filepath, 0):
+                pass
+        shutil.rmtree('locks')
+
+    def test_module_lock_filepath_helper(self):
+        self.assertEqual(os.path.join('locks', 'module-modules.a.lock'), module_lock_filepath_helper('locks', os.path.join('modules', 'a')))
+        self.assertEqual(os.path.join('locks', 'module-a.lock'), module_lock_filepath_helper('locks', 'a' + os.path.sep))
+
+    def test_remote_host_helper(self):
+        self.assertEqual('github.com', remote_host_helper('https://github.com/bitcoin/bitcoin.git'))
+        self.assertEqual('github.com', remote_host_helper('git@github.com:reactjs/redux.git'))
+        self.assertEqual('example.com', remote_host_helper('ssh://git@Example.com:2222/repo.git'))
+        self.assertIsNone(remote_host_helper('file:///tmp/repo.git'))
+        self.assertIsNone(remote_host_helper('../repo.git'))
+        self.assertIsNone(remote_host_helper('C:\\repos\\repo.git'))
+
+    def test_host_slot_helper(self):
+        lock_path = 'locks'
+        acquired, release = threading.Event(), threading.Event()
+        thread = threading.Thread(target=hold_host_slot, args=(lock_path, 'https://github.com/a.git', acquired, release))
+        thread.start()
+        acquired.wait()
+        waiting = threading.Event()
+        waiter = threading.Thread(target=hold_host_slot, args=(lock_path, 'git@github.com:b.git', waiting, threading.Event()))
+        waiter.daemon = True
+        waiter.start()
+        self.assertFalse(waiting.wait(0.5))
+        with host_slot_helper(lock_path, 'https://gitlab.com/c.git', 1):
+            with host_slot_helper(lock_path, '../d.git', 1):
+                pass
+        release.set()
+        thread.join()
+        self.assertTrue(waiting.wait(5))
+        shutil.rmtree(lock_path)
+
+    def test_start_ssh_multiplexing_helper(self):
+        path = os.path.abspath('tmp')
+        create_directory_helper(path)
+        Repo.init(os.path.join(path, 'remote.git'), bare=True).close()
+        ssh = os.path.join(path, 'ssh')
+        with open(ssh, 'w') as ssh_file:
+            ssh_file.write(FAKE_SSH)
+        os.chmod(ssh, stat.S_IRWXU)
+        stop = start_ssh_multiplexing_helper(ssh)
+        try:
+            self.assertTrue('ControlMaster=auto' in os.environ['GIT_SSH_COMMAND'])
+            ls_remote_helper('ssh://localhost' + path + '/remote.git')
+        finally:
+            stop()
+        self.assertFalse('GIT_SSH_COMMAND' in os.environ)
+        with open(os.path.join(path, 'ssh.log')) as log_file:
+            self.assertTrue('ControlPath=' in log_file.read())
+        shutil.rmtree(path, onerror=onerror_helper)
+
+    def test_remote_uses_ssh_helper(self):
+        self.assertTrue(remote_uses_ssh_helper('ssh://git@github.com/msembinelli/mpm.git'))
+        self.assertTrue(remote_uses_ssh_helper('git@github.com:msembinelli/mpm.git'))
+        self.assertFalse(remote_uses_ssh_helper('https://github.com/msembinelli/mpm.git'))
+        self.assertFalse(remote_uses_ssh_helper('file:///tmp/remote.git'))
+        self.assertFalse(remote_uses_ssh_helper('/tmp/remote.git'))
+
 class TestInit(unittest.TestCase):
     def setUp(self):
         self.context = HelperObject()
@@ -220,6 +755,92 @@ class TestInit(unittest.TestCase):
         with open(self.db_filepath, 'r') as database_file:
             self.assertTrue(self.db_table in database_file.read())
 
+    def test_init_ssh_multiplexing_on_first_ssh_remote(self):
+        context = click.Context(click.Command('mpm'))
+        metadata = mpm_init(context, self.db_table, self.db_path, self.db_filename, self.db_storage, self.gitignore, ssh_multiplexing=True)
+        self.assertFalse('GIT_SSH_COMMAND' in os.environ)
+        with metadata.host_slot('https://github.com/msembinelli/mpm.git'):
+            self.assertFalse('GIT_SSH_COMMAND' in os.environ)
+        with metadata.host_slot('git@github.com:msembinelli/mpm.git'):
+            self.assertTrue('ControlMaster=auto' in os.environ['GIT_SSH_COMMAND'])
+        context.close()
+        self.assertFalse('GIT_SSH_COMMAND' in os.environ)
+
+    def test_init_should_migrate(self):
+        os.mkdir(self.db_path)
+        yaml_filepath = os.path.join(self.db_path, 'mpm-db.yml')
+        with TinyDB(yaml_filepath, storage=YAMLStorage, default_table=self.db_table) as db:
+            db.insert({'name': 'broker'})
+        output_metadata_object = mpm_init(self.context, self.db_table, self.db_path, 'mpm-db.sqlite', SQLiteStorage, self.gitignore, migrate=True)
+
+        self.assertFalse(os.path.exists(yaml_filepath))
+        self.assertTrue(os.path.isfile(yaml_filepath + '.migrated'))
+        with TinyDB(output_metadata_object.filepath, storage=SQLiteStorage, default_table=self.db_table) as db:
+            self.assertEqual([{'name': 'broker'}], db.all())
+
+    def test_init_should_detect_storage(self):
+        os.mkdir(self.db_path)
+        sqlite_filepath = os.path.join(self.db_path, 'mpm-db.sqlite')
+        with TinyDB(sqlite_filepath, storage=SQLiteStorage, default_table=self.db_table) as db:
+            db.insert({'name': 'broker'})
+        for storage in [None, YAMLStorage]:
+            output_metadata_object = mpm_init(self.context, self.db_table, self.db_path, None, storage, self.gitignore)
+            self.assertEqual(sqlite_filepath, output_metadata_object.filepath)
+            self.assertEqual(SQLiteStorage, output_metadata_object.storage)
+        self.assertEqual(['mpm-db.sqlite'], [filename for filename in os.listdir(self.db_path) if filename.startswith('mpm-db')])
+
+class TestSQLiteStorage(unittest.TestCase):
+    def setUp(self):
+        self.filepath = 'test-db.sqlite'
+
+    def tearDown(self):
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(self.filepath + suffix):
+                os.remove(self.filepath + suffix)
+
+    def test_sqlite_storage_insert_update_remove(self):
+        module = Query()
+        with TinyDB(self.filepath, storage=SQLiteStorage, default_table='mpm') as db:
+            db.insert({'name': 'broker', 'path': 'modules/broker', 'remote_url': 'a', 'reference': 'remotes/origin/master'})
+            db.insert({'name': 'q2', 'path': 'modules/q2', 'remote_url': 'b', 'reference': 'remotes/origin/master'})
+            db.update({'reference': '2dc3342'}, module.name == 'broker')
+            db.remove(module.name == 'q2')
+        with TinyDB(self.filepath, storage=SQLiteStorage, default_table='mpm') as db:
+            self.assertEqual(1, len(db.all()))
+            self.assertEqual('2dc3342', db.get(module.name == 'broker')['reference'])
+
+    def test_sqlite_storage_empty_table(self):
+        with TinyDB(self.filepath, storage=SQLiteStorage, default_table='mpm') as db:
+            self.assertEqual([], db.all())
+        with TinyDB(self.filepath, storage=SQLiteStorage, default_table='mpm') as db:
+            self.assertEqual(set(['mpm']), db.tables())
+
+    def test_sqlite_storage_indexed_columns(self):
+        with TinyDB(self.filepath, storage=SQLiteStorage, default_table='mpm') as db:
+            db.insert({'name': 'broker', 'path': 'modules/broker', 'remote_url': 'https://github.com/msembinelli/broker.git'})
+        storage = SQLiteStorage(self.filepath)
+        rows = storage.connection.execute('SELECT name, path, remote_url FROM documents WHERE name = ?', ('broker',)).fetchall()
+        storage.close()
+        self.assertEqual([('broker', 'modules/broker', 'https://github.com/msembinelli/broker.git')], rows)
+
+class TestYAMLStorage(unittest.TestCase):
+    def setUp(self):
+        self.filepath = 'test-db.yaml'
+        YAMLStorage.cache = {}
+
+    def tearDown(self):
+        YAMLStorage.cache = None
+        os.remove(self.filepath)
+
+    def test_yaml_storage_cache_invalidated(self):
+        with TinyDB(self.filepath, storage=YAMLStorage) as db:
+            db.insert({'name': 'broker'})
+            self.assertEqual(1, len(db.all()))
+        with open(self.filepath, 'w') as handle:
+            handle.write('_default:\n  1:\n    name: broker\n  2:\n    name: q2-test\n')
+        with TinyDB(self.filepath, storage=YAMLStorage) as db:
+            self.assertEqual(2, len(db.all()))
+
 class TestInstall(unittest.TestCase):
     def setUp(self):
         self.context = HelperObject()
@@ -312,6 +933,27 @@ class TestInstall(unittest.TestCase):
         shutil.rmtree(directory, onerror=onerror_helper)
         remove_from_gitignore_helper('.gitignore', full_path)
 
+    def test_install_sparse(self):
+        remote_url = 'https://github.com/msembinelli/broker.git'
+        reference = 'remotes/origin/master'
+        directory = 'modules'
+        name = 'broker'
+        full_path = os.path.join(directory, name)
+        expected_db_entry = {'name': name, 'remote_url': remote_url, 'reference': reference, 'path': path_to_yaml_helper(full_path), 'sparse': ['docs']}
+
+        mpm_install(self.db, remote_url, reference, directory, None, ['docs'])
+
+        with TinyDB(self.db.filepath, storage=self.db.storage, default_table=self.db.table_name) as mpm_db:
+            module = Query()
+            db_entry = mpm_db.get(module.name == name)
+            self.assertEqual(db_entry, expected_db_entry)
+
+        repo = Repo(full_path)
+        self.assertEqual('true', repo.git.config('core.sparseCheckout'))
+        repo.close()
+        shutil.rmtree(directory, onerror=onerror_helper)
+        remove_from_gitignore_helper('.gitignore', full_path)
+
     def test_install_bad_parameters(self):
         remote_url = 'https://github.com/msembinelli/broker.git'
         reference = 'remotes/origin/master'
@@ -344,6 +986,7 @@ class TestUninstall(unittest.TestCase):
         mpm_install(self.db, remote_url, reference, directory, None)
         mpm_uninstall(self.db, name)
         self.assertFalse(os.path.exists(full_path))
+        self.assertEqual([], os.listdir(self.db.trash_path))
 
         with TinyDB(self.db.filepath, storage=self.db.storage, default_table=self.db.table_name) as mpm_db:
             module = Query()
@@ -401,6 +1044,143 @@ class TestUpdate(unittest.TestCase):
     def test_update_bad_parameters(self):
         self.assertRaises(Exception, mpm_update, None, self.name, self.reference, self.directory)
 
+    def test_update_all(self):
+        new_ref = '2dc33423188a7e06fa6e9725a0a74059b009ff6a'
+        repo = Repo(self.full_path)
+        repo.git.checkout(new_ref)
+        repo.close()
+        mpm_update_all(self.db)
+        repo = Repo(self.full_path)
+        self.assertNotEqual(repo.head.commit.hexsha, new_ref)
+        repo.close()
+
+    def test_update_all_filter(self):
+        new_ref = '2dc33423188a7e06fa6e9725a0a74059b009ff6a'
+        repo = Repo(self.full_path)
+        repo.git.checkout(new_ref)
+        repo.close()
+        mpm_update_all(self.db, 'q2*')
+        repo = Repo(self.full_path)
+        self.assertEqual(repo.head.commit.hexsha, new_ref)
+        repo.close()
+        mpm_update_all(self.db, 'modules/*')
+        repo = Repo(self.full_path)
+        self.assertNotEqual(repo.head.commit.hexsha, new_ref)
+        repo.close()
+
+    def test_update_all_no_module(self):
+        self.assertIsNone(mpm_update_all(self.db, 'broker-test'))
+
+class TestUpdateAllLocal(unittest.TestCase):
+    def setUp(self):
+        self.context = HelperObject()
+        self.db = mpm_init(self.context)
+        self.remote_path = os.path.abspath('remote')
+        self.old_sha = create_repo(self.remote_path)
+        for name in ['a', 'b']:
+            mpm_install(self.db, 'file://' + self.remote_path, 'remotes/origin/master', 'modules', name)
+        repo = Repo(self.remote_path)
+        self.new_sha = repo.index.commit('Empty commit').hexsha
+        repo.close()
+
+    def tearDown(self):
+        mpm_purge(self.db)
+        shutil.rmtree(self.remote_path, onerror=onerror_helper)
+        shutil.rmtree('.mpm', onerror=onerror_helper)
+
+    def test_update_all(self):
+        mpm_update_all(self.db, None, 0)
+        for name in ['a', 'b']:
+            self.assertEqual(self.new_sha, head_sha_helper(os.path.join('modules', name)))
+
+    def test_update_all_filter(self):
+        mpm_update_all(self.db, 'modules/a', 0)
+        self.assertEqual(self.new_sha, head_sha_helper(os.path.join('modules', 'a')))
+        self.assertEqual(self.old_sha, head_sha_helper(os.path.join('modules', 'b')))
+
+    def test_update_all_cached_refs(self):
+        mpm_update_all(self.db, 'a')
+        repo = Repo(self.remote_path)
+        newest_sha = repo.index.commit('Another empty commit').hexsha
+        repo.close()
+        # The cached refs resolve to the checked out commit of a, so they are listed again
+        mpm_update_all(self.db, 'a', 300)
+        self.assertEqual(newest_sha, head_sha_helper(os.path.join('modules', 'a')))
+
+    def test_is_ancestor_helper(self):
+        path = os.path.join('modules', 'a')
+        self.assertTrue(is_ancestor_helper(path, self.old_sha, self.old_sha))
+        self.assertFalse(is_ancestor_helper(path, self.new_sha, self.old_sha))
+        mpm_update_all(self.db, 'a')
+        self.assertTrue(is_ancestor_helper(path, self.old_sha, self.new_sha))
+        self.assertFalse(is_ancestor_helper(path, self.new_sha, self.old_sha))
+
+    def test_update_cached_refs(self):
+        mpm_update_all(self.db, 'a')
+        repo = Repo(self.remote_path)
+        newest_sha = repo.index.commit('Another empty commit').hexsha
+        repo.close()
+        mpm_update(self.db, 'a', None, None)
+        self.assertEqual(newest_sha, head_sha_helper(os.path.join('modules', 'a')))
+
+class TestOutdated(unittest.TestCase):
+    def setUp(self):
+        self.context = HelperObject()
+        self.db = mpm_init(self.context)
+        self.remote_url = 'https://github.com/msembinelli/broker.git'
+        self.reference = 'remotes/origin/master'
+        self.directory = 'modules'
+        self.name = 'broker'
+        self.full_path = os.path.join(self.directory, self.name)
+        mpm_install(self.db, self.remote_url, self.reference, self.directory, None)
+
+    def tearDown(self):
+        mpm_uninstall(self.db, self.name)
+        shutil.rmtree('.mpm', onerror=onerror_helper)
+
+    def test_outdated(self):
+        repo = Repo(self.full_path)
+        repo.git.checkout('2dc33423188a7e06fa6e9725a0a74059b009ff6a')
+        repo.close()
+        self.assertIsNone(mpm_outdated(self.db))
+        self.assertTrue(os.path.isfile(self.db.remote_cache_path))
+        repo = Repo(self.full_path)
+        self.assertEqual(repo.head.commit.hexsha, '2dc33423188a7e06fa6e9725a0a74059b009ff6a')
+        repo.close()
+
+    def test_outdated_up_to_date(self):
+        self.assertIsNone(mpm_outdated(self.db, 0))
+
+class TestOutdatedLocal(unittest.TestCase):
+    def setUp(self):
+        self.context = HelperObject()
+        self.db = mpm_init(self.context)
+        self.remote_path = os.path.abspath('remote')
+        self.old_sha = create_repo(self.remote_path)
+        for name in ['a', 'b']:
+            mpm_install(self.db, 'file://' + self.remote_path, 'remotes/origin/master', 'modules', name)
+
+    def tearDown(self):
+        mpm_purge(self.db)
+        shutil.rmtree(self.remote_path, onerror=onerror_helper)
+        shutil.rmtree('.mpm', onerror=onerror_helper)
+
+    def test_outdated(self):
+        repo = Repo(self.remote_path)
+        new_sha = repo.index.commit('Empty commit').hexsha
+        repo.close()
+        result = CliRunner().invoke(cli, ['outdated', '-t', '0'])
+        self.assertEqual(0, result.exit_code)
+        rows = [line.split() for line in result.output.splitlines()]
+        for name in ['a', 'b']:
+            self.assertTrue([name, 'remotes/origin/master', self.old_sha[:7], new_sha[:7]] in rows)
+            self.assertEqual(self.old_sha, head_sha_helper(os.path.join('modules', name)))
+
+    def test_outdated_up_to_date(self):
+        result = CliRunner().invoke(cli, ['outdated', '-t', '0'])
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue('All modules up to date!' in result.output)
+
 class TestConvert(unittest.TestCase):
     def setUp(self):
         self.context = HelperObject()
@@ -431,6 +1211,7 @@ class TestConvert(unittest.TestCase):
             self.assertIsNotNone(db_entry)
         with open('.gitmodules', 'r') as gitmodules:
             self.assertTrue(expected_module_name not in gitmodules.read())
+        self.assertTrue(os.path.isdir(os.path.join(expected_module_name, '.git')))
         os.chdir(dir_before)
 
     def test_convert_soft(self):
@@ -468,6 +1249,49 @@ class TestConvert(unittest.TestCase):
         self.assertIsNone(mpm_convert(new_db, filename, product, False))
         os.remove('.gitmodules')
 
+class TestConvertLocal(unittest.TestCase):
+    def setUp(self):
+        self.remote_path = os.path.abspath('remote')
+        self.sha = create_repo(self.remote_path)
+        self.super_path = os.path.abspath('super')
+        create_repo(self.super_path)
+        repo = Repo(self.super_path)
+        repo.git.execute(['git', '-c', 'protocol.file.allow=always', 'submodule', 'add', '-q', 'file://' + self.remote_path, 'libone'])
+        repo.index.commit('Added a submodule')
+        repo.close()
+        self.workspace_path = os.path.abspath('workspace')
+        os.mkdir(self.workspace_path)
+        self.dir_before = os.getcwd()
+
+    def tearDown(self):
+        os.chdir(self.dir_before)
+        for path in [self.remote_path, self.super_path, self.workspace_path]:
+            shutil.rmtree(path, onerror=onerror_helper)
+
+    def test_convert_soft_update(self):
+        os.chdir(self.super_path)
+        db = mpm_init(HelperObject())
+        mpm_convert(db, 'package.yaml', '_default', False)
+        self.assertTrue(os.path.isfile(os.path.join('libone', '.git')))
+        mpm_update(db, 'libone', None, None, checkout={'workers': 2})
+        self.assertEqual('2', Git('libone').execute(['git', 'config', 'checkout.workers']))
+        self.assertEqual(self.sha, head_sha_helper('libone'))
+
+    def test_convert_freeze_load(self):
+        os.chdir(self.super_path)
+        mpm_convert(mpm_init(HelperObject()), 'package.yaml', '_default', False)
+        with TinyDB('package.yaml', storage=YAMLStorage) as manifest:
+            self.assertEqual('libone', manifest.table('_default').get(Query().name == 'libone')['path'])
+        shutil.copy('package.yaml', self.workspace_path)
+        os.chdir(self.workspace_path)
+        db = mpm_init(HelperObject())
+        mpm_load(db, 'package.yaml', '_default')
+        self.assertEqual(self.sha, head_sha_helper('libone'))
+        with TinyDB(db.filepath, storage=db.storage, default_table=db.table_name) as mpm_db:
+            self.assertEqual('libone', mpm_db.get(Query().name == 'libone')['path'])
+        with open('.gitignore') as gitignore:
+            self.assertIn('libone/', gitignore.read().splitlines())
+
 class TestLoad(unittest.TestCase):
     def setUp(self):
         self.context = HelperObject()
@@ -506,6 +1330,180 @@ class TestLoad(unittest.TestCase):
         self.assertFalse(os.path.isfile(filename))
         self.assertIsNone(mpm_load(self.db, filename, product))
 
+class TestLoadProducts(unittest.TestCase):
+    def setUp(self):
+        self.context = HelperObject()
+        self.db = mpm_init(self.context)
+        self.remote_path = os.path.abspath('remote')
+        create_repo(self.remote_path)
+        self.filename = 'package-test.yaml'
+        self.entry = '  {0}: {{name: {1}, path: modules/{1}, reference: {2}, remote_url: \'file://' + self.remote_path + '\'}}\n'
+
+    def tearDown(self):
+        mpm_purge(self.db)
+        os.remove(self.filename)
+        shutil.rmtree(self.remote_path, onerror=onerror_helper)
+
+    def test_load_products(self):
+        with open(self.filename, 'w') as manifest:
+            manifest.write('A:\n' + self.entry.format(1, 'a', 'remotes/origin/master') + self.entry.format(2, 'b', 'remotes/origin/master') +
+                           'B:\n' + self.entry.format(1, 'b', 'remotes/origin/master') + self.entry.format(2, 'c', 'remotes/origin/master'))
+        mpm_load(self.db, self.filename, ['A', 'B'], product_dbs=True)
+        with self.db.open_db() as mpm_db:
+            self.assertEqual(['a', 'b', 'c'], sorted(entry['name'] for entry in mpm_db.all()))
+        product_filepath = os.path.join(os.path.dirname(self.db.filepath), 'products', 'B', os.path.basename(self.db.filepath))
+        with TinyDB(product_filepath, storage=self.db.storage, default_table=self.db.table_name) as product_db:
+            self.assertEqual(['b', 'c'], sorted(entry['name'] for entry in product_db.all()))
+        shutil.rmtree(os.path.dirname(os.path.dirname(product_filepath)))
+
+    def test_load_products_conflict(self):
+        with open(self.filename, 'w') as manifest:
+            manifest.write('A:\n' + self.entry.format(1, 'a', 'remotes/origin/master') +
+                           'B:\n' + self.entry.format(1, 'a', 'remotes/origin/other'))
+        with self.assertRaises(click.ClickException):
+            mpm_load(self.db, self.filename, None)
+        with self.db.open_db() as mpm_db:
+            self.assertEqual([], mpm_db.all())
+
+    def test_load_products_missing(self):
+        with open(self.filename, 'w') as manifest:
+            manifest.write('A:\n' + self.entry.format(1, 'a', 'remotes/origin/master'))
+        with self.assertRaises(click.ClickException) as context:
+            mpm_load(self.db, self.filename, ['A', 'B', 'C'])
+        self.assertTrue('B, C' in context.exception.message)
+        with self.db.open_db() as mpm_db:
+            self.assertEqual([], mpm_db.all())
+
+class TestStore(unittest.TestCase):
+    def setUp(self):
+        self.store_path = os.path.abspath('store')
+        self.context = HelperObject()
+        self.db = mpm_init(self.context, store_path=self.store_path)
+        self.remote_path = os.path.abspath('remote')
+        create_repo(self.remote_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.store_path, onerror=onerror_helper)
+        shutil.rmtree(self.remote_path, onerror=onerror_helper)
+
+    def test_install_uninstall_store(self):
+        remote_url = 'file://' + self.remote_path
+        for name in ['a', 'b']:
+            mpm_install(self.db, remote_url, 'remotes/origin/master', 'modules', name)
+        self.assertEqual(os.readlink(os.path.join('modules', 'a')), os.readlink(os.path.join('modules', 'b')))
+        with open('.gitignore') as gitignore_file:
+            self.assertTrue('modules/a\n' in gitignore_file.readlines())
+        entry_path = os.readlink(os.path.join('modules', 'a'))
+        mpm_uninstall(self.db, 'a')
+        self.assertTrue(os.path.isfile(os.path.join('modules', 'b', 'file.txt')))
+        mpm_uninstall(self.db, 'b')
+        self.assertFalse(os.path.exists(entry_path))
+        with open('.gitignore') as gitignore_file:
+            self.assertFalse('modules/a\n' in gitignore_file.readlines())
+
+    def test_maintain_skips_store(self):
+        mpm_install(self.db, 'file://' + self.remote_path, 'remotes/origin/master', 'modules', 'a')
+        entry_path = os.readlink(os.path.join('modules', 'a'))
+        self.assertIsNone(mpm_maintain(self.db, 1))
+        self.assertFalse(os.path.isfile(os.path.join(entry_path, '.git', 'objects', 'info', 'commit-graph')))
+        mpm_purge(self.db)
+
+class TestPrefetch(unittest.TestCase):
+    def setUp(self):
+        self.context = HelperObject()
+        self.db = mpm_init(self.context)
+        self.remote_path = os.path.abspath('remote')
+        create_repo(self.remote_path)
+        mpm_install(self.db, 'file://' + self.remote_path, 'remotes/origin/master', 'modules', 'a')
+
+    def tearDown(self):
+        mpm_purge(self.db)
+        shutil.rmtree(self.remote_path, onerror=onerror_helper)
+
+    def test_prefetch_then_update_offline(self):
+        repo = Repo(self.remote_path)
+        sha = repo.index.commit('Empty commit').hexsha
+        repo.close()
+        mpm_prefetch(self.db)
+        path = os.path.join('modules', 'a')
+        prefetched = prefetch_time_helper(path)
+        self.assertIsNotNone(prefetched)
+        mpm_prefetch(self.db)
+        self.assertEqual(prefetched, prefetch_time_helper(path))
+        shutil.move(self.remote_path, self.remote_path + '.moved')
+        try:
+            mpm_update_all(self.db, None, 300)
+        finally:
+            shutil.move(self.remote_path + '.moved', self.remote_path)
+        self.assertEqual(sha, head_sha_helper(path))
+
+class TestDoctor(unittest.TestCase):
+    def setUp(self):
+        self.context = HelperObject()
+        self.db = mpm_init(self.context)
+        self.remote_path = os.path.abspath('remote')
+        create_repo(self.remote_path)
+        for name in ['a', 'b']:
+            mpm_install(self.db, 'file://' + self.remote_path, 'remotes/origin/master', 'modules', name)
+
+    def tearDown(self):
+        mpm_purge(self.db)
+        shutil.rmtree(self.remote_path, onerror=onerror_helper)
+
+    def test_doctor(self):
+        runner = CliRunner()
+        result = runner.invoke(cli, ['doctor'])
+        self.assertEqual('No problems found!\n', result.output)
+        shutil.rmtree(os.path.join('modules', 'b'), onerror=onerror_helper)
+        result = runner.invoke(cli, ['doctor'])
+        self.assertEqual('b: it is not checked out, run mpm install again\n', result.output)
+        mpm_install(self.db, 'file://' + self.remote_path, 'remotes/origin/master', 'modules', 'b')
+
+    def test_doctor_perf_json(self):
+        runner = CliRunner()
+        result = runner.invoke(cli, ['doctor', '--perf', '--format', 'json'])
+        self.assertEqual(0, result.exit_code, result.output)
+        reports = json.loads(result.output)
+        self.assertEqual(['a', 'b'], sorted(report['name'] for report in reports))
+        self.assertTrue(reports[0]['cost'] >= reports[1]['cost'])
+        result = runner.invoke(cli, ['doctor', '--perf', '--no-fetch'])
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertTrue(result.output.startswith('name'))
+
+class TestLoadResume(unittest.TestCase):
+    def setUp(self):
+        self.context = HelperObject()
+        self.db = mpm_init(self.context)
+        self.remote_path = os.path.abspath('remote')
+        create_repo(self.remote_path)
+        self.filename = 'package-test.yaml'
+        entry = '  {0}: {{name: {1}, path: modules/{1}, reference: remotes/origin/master, remote_url: \'file://{2}\'}}\n'
+        with open(self.filename, 'w') as manifest:
+            manifest.write('_default:\n' + entry.format(1, 'a', self.remote_path) + entry.format(2, 'b', self.remote_path))
+
+    def tearDown(self):
+        mpm_purge(self.db)
+        os.remove(self.filename)
+        shutil.rmtree(self.remote_path, onerror=onerror_helper)
+
+    def test_load_resume(self):
+        mpm_load(self.db, self.filename, '_default')
+        partial_path = os.path.join('modules', 'b')
+        shutil.rmtree(partial_path, onerror=onerror_helper)
+        os.makedirs(os.path.join(partial_path, '.git'))
+        with self.db.open_db() as mpm_db:
+            mpm_db.remove(Query().name == 'b')
+        self.db.journal(partial_path, 'b', 'file://' + self.remote_path, 'remotes/origin/master')('clone-started')
+        runner = CliRunner()
+        result = runner.invoke(cli, ['load', '--resume', self.filename])
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertTrue('Skipped 1 modules already loaded.' in result.output)
+        self.assertTrue('Removing the partial clone' in result.output)
+        self.assertTrue(os.path.isfile(os.path.join(partial_path, 'file.txt')))
+        self.assertIsNone(read_journal_helper(self.db.journal_path, partial_path))
+        with self.db.open_db() as mpm_db:
+            self.assertEqual(['a', 'b'], sorted(entry['name'] for entry in mpm_db.all()))
+
 class TestPurge(unittest.TestCase):
     def setUp(self):
         self.context = HelperObject()
@@ -529,6 +1527,104 @@ class TestPurge(unittest.TestCase):
         self.assertIsNone(mpm_purge(self.db))
         self.assertFalse(os.path.exists(self.full_path))
 
+class TestGC(unittest.TestCase):
+    def setUp(self):
+        self.context = HelperObject()
+        self.db = mpm_init(self.context)
+
+    def tearDown(self):
+        shutil.rmtree('.mpm', onerror=onerror_helper)
+
+    def test_gc(self):
+        path = 'tmp'
+        create_directory_helper(path)
+        with_open_or_create_file_helper(os.path.join(path, 'file.txt'), 'a+')
+        move_to_trash_helper(path, self.db.trash_path)
+        self.assertIsNone(mpm_gc(self.db))
+        self.assertEqual([], os.listdir(self.db.trash_path))
+
+    def test_gc_nothing_to_collect(self):
+        self.assertIsNone(mpm_gc(self.db))
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.context = HelperObject()
+        self.db = mpm_init(self.context)
+        self.socket_path = os.path.join('.mpm', 'test.sock')
+        self.thread = threading.Thread(target=serve_daemon, args=(cli, self.socket_path, 30))
+        self.thread.start()
+        while not is_daemon_running(self.socket_path):
+            time.sleep(0.05)
+
+    def tearDown(self):
+        stop_daemon(self.socket_path)
+        self.thread.join()
+        shutil.rmtree('.mpm', onerror=onerror_helper)
+
+    def test_daemon_show(self):
+        output, exit_code = forward_to_daemon(['show'], self.socket_path)
+        self.assertEqual(0, exit_code)
+        self.assertTrue('no modules installed' in output)
+
+    def test_daemon_usage_error(self):
+        output, exit_code = forward_to_daemon(['doctor', '--format', 'xml'], self.socket_path)
+        self.assertEqual(2, exit_code)
+        self.assertTrue('Usage: mpm doctor' in output)
+
+    def test_daemon_only_serves_read_only_commands(self):
+        output, exit_code = forward_to_daemon(['--lock-timeout', '1', 'show'], self.socket_path)
+        self.assertEqual(0, exit_code)
+        for argv in [['install', 'file:///missing.git'], ['update', '--all'], ['--storage', 'yaml', 'load', 'package.yaml'], ['outdated'], ['doctor', '--perf', '--no-fetch'], ['--help']]:
+            self.assertIsNone(forward_to_daemon(argv, self.socket_path))
+
+    def test_daemon_other_workspace(self):
+        path = 'tmp'
+        create_directory_helper(path)
+        dir_before = os.getcwd()
+        os.chdir(path)
+        self.assertIsNone(forward_to_daemon(['show'], os.path.join('..', self.socket_path)))
+        os.chdir(dir_before)
+        os.rmdir(path)
+
+    def test_daemon_not_running(self):
+        self.assertIsNone(forward_to_daemon(['show'], os.path.join('.mpm', 'missing.sock')))
+        self.assertFalse(stop_daemon(os.path.join('.mpm', 'missing.sock')))
+
+class TestMaintain(unittest.TestCase):
+    def setUp(self):
+        self.context = HelperObject()
+        self.db = mpm_init(self.context)
+        self.full_path = os.path.join('modules', 'local')
+        create_repo(self.full_path)
+        with TinyDB(self.db.filepath, storage=self.db.storage, default_table=self.db.table_name) as mpm_db:
+            mpm_db.insert({'name': 'local', 'remote_url': 'none', 'reference': 'master', 'path': 'modules/local'})
+
+    def tearDown(self):
+        shutil.rmtree('modules', onerror=onerror_helper)
+        shutil.rmtree('.mpm', onerror=onerror_helper)
+
+    def test_maintain(self):
+        self.assertIsNone(mpm_maintain(self.db, 2))
+        self.assertTrue(os.path.isfile(os.path.join(self.full_path, '.git', 'objects', 'info', 'commit-graph')))
+
+    def test_maintain_module_locked(self):
+        self.db.lock_timeout = 0
+        acquired, release = threading.Event(), threading.Event()
+        thread = threading.Thread(target=hold_lock, args=(module_lock_filepath_helper(self.db.lock_path, self.full_path), acquired, release))
+        thread.start()
+        acquired.wait()
+        try:
+            with self.assertRaises(click.ClickException):
+                mpm_maintain(self.db, 1)
+        finally:
+            release.set()
+            thread.join()
+        self.assertIsNone(mpm_maintain(self.db, 1))
+
+    def test_maintain_nothing_to_maintain(self):
+        self.assertIsNone(mpm_maintain(self.db, None, 'broker'))
+        self.assertFalse(os.path.isfile(os.path.join(self.full_path, '.git', 'objects', 'info', 'commit-graph')))
+
 class TestFreeze(unittest.TestCase):
     def setUp(self):
         self.context = HelperObject()
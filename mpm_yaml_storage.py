@@ -1,3 +1,5 @@
+import copy
+import os
 import yaml
 import sys
 from tinydb.database import Document
@@ -16,14 +18,29 @@ yaml.add_representer(unicode, represent_uni)
 yaml.add_representer(Document, represent_doc)
 
 class YAMLStorage(Storage):
+    # Parsed file contents keyed by path, shared by all instances.
+    # Disabled by default. Long running processes like the daemon
+    # set it to a dict; entries are dropped as soon as the file's
+    # size, inode or modification time changes.
+    cache = None
+
     def __init__(self, filename):
         self.filename = filename
         touch(filename, False)
 
     def read(self):
+        if YAMLStorage.cache is not None:
+            stat = os.stat(self.filename)
+            stamp = (stat.st_mtime, stat.st_size, stat.st_ino)
+            key = os.path.abspath(self.filename)
+            cached = YAMLStorage.cache.get(key)
+            if cached and cached[0] == stamp:
+                return copy.deepcopy(cached[1])
         with open(self.filename) as handle:
             data = yaml.safe_load(handle.read())
-            return data
+        if YAMLStorage.cache is not None:
+            YAMLStorage.cache[key] = (stamp, copy.deepcopy(data))
+        return data
 
     def write(self, data):
         with open(self.filename, 'w') as handle:
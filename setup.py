@@ -3,7 +3,7 @@ from setuptools import setup
 setup(
     name='mpm',
     version='0.2',
-    py_modules=['mpm_cli', 'mpm', 'mpm_yaml_storage', 'mpm_helpers'],
+    py_modules=['mpm_cli', 'mpm', 'mpm_yaml_storage', 'mpm_sqlite_storage', 'mpm_daemon', 'mpm_helpers'],
     test_suite='mpm_test',
     install_requires=[
         'click',
@@ -13,6 +13,6 @@ setup(
     ],
     entry_points='''
         [console_scripts]
-        mpm=mpm_cli:cli
+        mpm=mpm_daemon:main
     ''',
 )